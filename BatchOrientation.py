@@ -0,0 +1,181 @@
+# Copyright (c) 2022 Jaime van Kessel
+# The OrientationPLugin is released under the terms of the AGPLv3 or higher.
+
+"""Orients STL files without Cura, in a pool of worker processes.
+
+The result of each file is appended as a line of JSON to the output file as soon as it is done. It holds the Euler
+axis and angle, the rotation matrix, the unprintability and the timings. A run that was interrupted continues where
+it stopped: files that already have a result for the same settings, size and modification time are skipped.
+
+    python BatchOrientation.py models/ extra.stl -o orientations.jsonl --extended -j 8 --rotated oriented/
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    from .MeshTweaker import Tweak
+    from .StlFile import isBinaryStl, mapStl, readStl, writeStl
+except ImportError:  # Run as a script
+    from MeshTweaker import Tweak
+    from StlFile import isBinaryStl, mapStl, readStl, writeStl
+
+
+def findStlFiles(paths: List[str]) -> Iterator[Tuple[str, str]]:
+    """The STL files of the given files and directories, with their path relative to the given directory."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield os.path.abspath(path), os.path.basename(path)
+            continue
+        for directory, sub_directories, file_names in os.walk(path):
+            sub_directories.sort()
+            for file_name in sorted(file_names):
+                if file_name.lower().endswith(".stl"):
+                    file_path = os.path.join(directory, file_name)
+                    yield os.path.abspath(file_path), os.path.relpath(file_path, path)
+
+
+def orientFile(path: str, relative_path: str, settings: Dict[str, Any], rotated_directory: Optional[str]) -> Dict[str, Any]:
+    """Orients a single file, in a worker process. Errors are reported in the result instead of raised."""
+    entry = {"file": path, "settings": settings}  # type: Dict[str, Any]
+    try:
+        file_stat = os.stat(path)
+        entry.update({"size": file_stat.st_size, "mtime": file_stat.st_mtime})
+        start = time.perf_counter()
+        if isBinaryStl(path):
+            content = mapStl(path)  # The Tweaker takes the stored normals and vertices straight from the file
+            vertices = content[:, 1:4]
+        else:
+            content = vertices = readStl(path)
+        loaded = time.perf_counter()
+        result = Tweak(content, verbose = False, **settings)
+        tweaked = time.perf_counter()
+
+        entry.update({
+            "status": "ok",
+            "euler_axis": [float(component) for component in result.euler_parameter[0]],
+            "euler_angle": float(result.euler_parameter[1]),
+            "matrix": np.asarray(result.matrix, dtype = np.float64).tolist(),
+            "alignment": [float(component) for component in result.alignment],
+            "unprintability": float(result.unprintability),
+            "bottom_area": float(result.bottom_area),
+            "overhang_area": float(result.overhang_area),
+            "stats": result.stats.as_dict(),
+            "timings": {"load": loaded - start, "tweak": tweaked - loaded},
+        })
+
+        if rotated_directory is not None:
+            rotated = np.matmul(np.asarray(vertices, dtype = np.float64), result.matrix)
+            rotated[..., 2] -= rotated[..., 2].min()  # put it on the build plate
+            rotated_path = os.path.join(rotated_directory, relative_path)
+            os.makedirs(os.path.dirname(rotated_path) or ".", exist_ok = True)
+            writeStl(rotated_path, rotated, header = b"Oriented by the Tweaker")
+            entry["rotated_file"] = os.path.abspath(rotated_path)
+            entry["timings"]["write"] = time.perf_counter() - tweaked
+    except Exception as e:
+        entry.update({"status": "error", "error": "{type}: {error}".format(type = type(e).__name__, error = e)})
+    return entry
+
+
+def loadFinished(output_path: str) -> Dict[str, Dict[str, Any]]:
+    """The successful results of an earlier run by file, the last one wins."""
+    finished = {}  # type: Dict[str, Dict[str, Any]]
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path) as output_file:
+        for line in output_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:  # The last line of an interrupted run may be incomplete
+                continue
+            if entry.get("status") == "ok":
+                finished[entry["file"]] = entry
+    return finished
+
+
+def isFinished(entry: Optional[Dict[str, Any]], path: str, settings: Dict[str, Any], rotated_directory: Optional[str]) -> bool:
+    if entry is None or entry.get("settings") != settings or not os.path.exists(path):
+        return False
+    file_stat = os.stat(path)
+    if entry.get("size") != file_stat.st_size or entry.get("mtime") != file_stat.st_mtime:
+        return False
+    return rotated_directory is None or os.path.exists(entry.get("rotated_file", ""))
+
+
+def main(arguments: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs = "+", help = "STL files, or directories that are searched for STL files")
+    parser.add_argument("-o", "--output", default = "orientations.jsonl", help = "file the JSON lines are appended to")
+    parser.add_argument("-j", "--jobs", type = int, default = os.cpu_count() or 1, help = "amount of worker processes")
+    parser.add_argument("--extended", action = "store_true", help = "use the extended mode, which is slower but better")
+    parser.add_argument("--min-volume", action = "store_true", help = "minimize the volume of the support material")
+    parser.add_argument("--seed", type = int, default = 0, help = "seed of the random candidates of the extended mode")
+    parser.add_argument("--hull", action = "store_true", help = "add the biggest faces of the convex hull as candidates")
+    parser.add_argument("--hull-min-support", type = float, default = 0, metavar = "FRACTION",
+                        help = "in the hull mode, drop the candidates with less area on the first layer than this "
+                               "fraction of the biggest one")
+    parser.add_argument("--time-budget", type = float, default = 0, metavar = "SECONDS",
+                        help = "return the best orientation found within this time per file, 0 is unlimited")
+    parser.add_argument("--rotated", metavar = "DIRECTORY", help = "write the oriented models as binary STL files here")
+    parser.add_argument("--force", action = "store_true", help = "orient all files again, even if they have a result")
+    options = parser.parse_args(arguments)
+
+    settings = {"extended_mode": options.extended, "min_volume": options.min_volume, "seed": options.seed}
+    if options.hull:  # Only set if used, so the results of earlier runs stay valid
+        settings["hull"] = True
+        if options.hull_min_support > 0:
+            settings["hull_min_support"] = options.hull_min_support
+    if options.time_budget > 0:
+        settings["time_budget"] = options.time_budget
+    finished = {} if options.force else loadFinished(options.output)
+    found = list(findStlFiles(options.paths))
+    files = [(path, relative_path) for path, relative_path in found
+             if not isFinished(finished.get(path), path, settings, options.rotated)]
+    print("Orienting {count} files, {skipped} already have a result".format(
+        count = len(files), skipped = len(found) - len(files)), file = sys.stderr)
+
+    failures = 0
+    with open(options.output, "a") as output_file:
+        def write(entry: Dict[str, Any], done: int) -> None:
+            output_file.write(json.dumps(entry) + "\n")
+            output_file.flush()
+            if entry["status"] == "ok":
+                print("[{done}/{count}] {file}: unprintability {unprintability:.3f} in {time:.2f} s".format(
+                    done = done, count = len(files), file = entry["file"], unprintability = entry["unprintability"],
+                    time = sum(entry["timings"].values())), file = sys.stderr)
+            else:
+                print("[{done}/{count}] {file}: {error}".format(done = done, count = len(files), file = entry["file"],
+                                                                 error = entry["error"]), file = sys.stderr)
+
+        if options.jobs <= 1:
+            for done, (path, relative_path) in enumerate(files, start = 1):
+                entry = orientFile(path, relative_path, settings, options.rotated)
+                failures += entry["status"] != "ok"
+                write(entry, done)
+        else:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers = options.jobs, mp_context = context) as executor:
+                futures = {executor.submit(orientFile, path, relative_path, settings, options.rotated): path
+                           for path, relative_path in files}
+                for done, future in enumerate(as_completed(futures), start = 1):
+                    try:
+                        entry = future.result()
+                    except Exception as e:  # The worker process died, e.g. because it ran out of memory
+                        entry = {"file": futures[future], "settings": settings, "status": "error",
+                                 "error": "{type}: {error}".format(type = type(e).__name__, error = e)}
+                    failures += entry["status"] != "ok"
+                    write(entry, done)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,35 +1,115 @@
 from UM.Job import Job
+from UM.Logger import Logger
 from UM.Operations.GroupedOperation import GroupedOperation
 from UM.Operations.RotateOperation import RotateOperation
 from cura.CuraApplication import CuraApplication
-from .MeshTweaker import Tweak
+from .MeshTweaker import PARAMETER, PARAMETER_VOL, Tweak, TweakCancelled, euler_rotation
+from .NodeVersion import NodeCancelToken, NodeVersion
 from UM.Math.Quaternion import Quaternion
 from UM.Math.Vector import Vector
+from UM.Resources import Resources
 from UM.Scene.SceneNode import SceneNode
+from concurrent.futures import CancelledError, wait
+import cProfile
+import importlib
 import math
+import numpy
+import os
+import re
+import sys
+import threading
+import time
 
-from typing import List, TYPE_CHECKING, Optional
+from typing import Any, Callable, Dict, List, TYPE_CHECKING, Optional, Set, Tuple
 
 if TYPE_CHECKING:
     from UM.Message import Message
+    from .OrientationCache import OrientationCache
+
+
+def _importWorkerModule():
+    # The worker processes import the worker module by its name, which only works if it is a top level module.
+    plugin_path = os.path.dirname(os.path.abspath(__file__))
+    if plugin_path not in sys.path:
+        sys.path.append(plugin_path)
+    return importlib.import_module("OrientationWorker")
 
 
 class CalculateOrientationJob(Job):
-    def __init__(self, nodes: List[SceneNode], extended_mode: bool = False, message: Optional["Message"] = None) -> None:
+    def __init__(self, nodes: List[SceneNode], extended_mode: bool = False, message: Optional["Message"] = None,
+                 cache: Optional["OrientationCache"] = None, prepared: Optional[Dict[SceneNode, Tweak]] = None,
+                 progress_callback: Optional[Callable[[float], None]] = None) -> None:
         super().__init__()
         self._message = message
+        self._progress_callback = progress_callback  # Gets the progress instead of the message, if it is set
         self._nodes = nodes
         self._extended_mode = extended_mode
+        self._cache = cache
+        self._prepared = prepared if prepared is not None else {}  # Nodes of which the candidates were already gathered
+        self._cancel_token = threading.Event()
+        self._versions = {}  # type: Dict[SceneNode, NodeVersion]  # The versions the orientations are calculated for
+        self._discarded = set()  # type: Set[SceneNode]
+        self._profile_directory = None  # type: Optional[str]
+        self._preprocess_memory_limit = None  # type: Optional[int]
+        self._lod_winner_changes = []  # type: List[bool]  # Whether the coarse ranking changed the winner, if verified
 
     def run(self) -> None:
         op = GroupedOperation()
+        preferences = CuraApplication.getInstance().getPreferences()
+        worker_count = int(preferences.getValue("OrientationPlugin/worker_count"))
+        tweak_arguments = {
+            "extended_mode": self._extended_mode,
+            "verbose": False,
+            "min_volume": preferences.getValue("OrientationPlugin/min_volume"),
+            "lod_ratio": float(preferences.getValue("OrientationPlugin/lod_ratio")),
+            "lod_top_k": int(preferences.getValue("OrientationPlugin/lod_top_k")),
+            "lod_verify": bool(preferences.getValue("OrientationPlugin/lod_verify")),
+            "refine_budget": int(preferences.getValue("OrientationPlugin/refine_budget")),
+            "prune": bool(preferences.getValue("OrientationPlugin/prune")),
+            "seed": int(preferences.getValue("OrientationPlugin/seed")),
+            "hull": bool(preferences.getValue("OrientationPlugin/hull")),
+            "hull_min_support": float(preferences.getValue("OrientationPlugin/hull_min_support")),
+            "time_budget": float(preferences.getValue("OrientationPlugin/time_budget")),
+            "backend": str(preferences.getValue("OrientationPlugin/backend")),
+            "preprocess_memory_limit": self.getPreprocessMemoryLimit(),
+            "threads": int(preferences.getValue("OrientationPlugin/threads")) or max((os.cpu_count() or 1) // worker_count, 1),
+        }
+        self._preprocess_memory_limit = tweak_arguments["preprocess_memory_limit"]
 
-        for node in self._nodes:
-            transformed_vertices = node.getMeshDataTransformed().getVertices()
+        if preferences.getValue("OrientationPlugin/profile"):
+            self._profile_directory = os.path.join(Resources.getDataStoragePath(), "orientation_profiles")
+            worker_count = 1  # The worker processes can not be profiled from here
+
+        nodes, copies = self._groupCopies()
+        orientations = None
+        try:
+            if worker_count > 1 and len(nodes) > 1:
+                try:
+                    orientations = self._calculateParallel(nodes, tweak_arguments, worker_count)
+                except TweakCancelled:
+                    raise
+                except Exception:
+                    Logger.logException("w", "Could not calculate the orientations in worker processes, calculating them one after another instead.")
+            if orientations is None:
+                orientations = self._calculateSequential(nodes, tweak_arguments)
+        except TweakCancelled:
+            Logger.log("i", "The calculation of the orientation was cancelled.")
+            return  # Leave all nodes as they are
+        if self._lod_winner_changes:
+            Logger.log("i", "The coarse ranking changed the best orientation of {changed} of {count} verified objects".format(
+                changed = sum(self._lod_winner_changes), count = len(self._lod_winner_changes)))
 
-            result = Tweak(transformed_vertices, extended_mode = self._extended_mode, verbose=False, progress_callback=self.updateProgress, min_volume=CuraApplication.getInstance().getPreferences().getValue("OrientationPlugin/min_volume"))
+        for node, (original, rotation) in copies.items():
+            if original in orientations and self._versions[node].isCurrent():
+                orientations[node] = self._rotateOrientation(orientations[original], rotation, tweak_arguments)
 
-            [v, phi] = result.euler_parameter
+        for node in self._nodes:
+            if node not in orientations:
+                continue  # It changed while it was being oriented
+            if not self._versions[node].isCurrent():
+                self._logStale(node)
+                continue
+            [v, phi] = orientations[node]["euler_parameter"]
 
             # Convert the new orientation into quaternion
             new_orientation = Quaternion.fromAngleAxis(phi, Vector(-v[0], -v[1], -v[2]))
@@ -40,13 +120,235 @@ class CalculateOrientationJob(Job):
             # Ensure node gets the new orientation, and rotate it around the center of the object.
             # The rotating around the center prevents it from getting all kinds of weird new positions on the buildplate
             op.addOperation(RotateOperation(node, new_orientation, rotate_around_point = node.getBoundingBox().center))
+        op.push()
+
+    def _calculateSequential(self, nodes: List[SceneNode], tweak_arguments: Dict[str, Any]) -> Dict[SceneNode, Dict[str, Any]]:
+        orientations = {}  # type: Dict[SceneNode, Dict[str, Any]]
+        for node in nodes:
+            version = self._takeVersion(node)
+            cache_key, cached_result = self._lookUp(version, tweak_arguments)
+            if cached_result is not None:
+                Logger.log("i", "Orientation of {name} was found in the cache".format(name = node.getName()))
+                orientations[node] = self._cachedOrientation(cached_result)
+            else:
+                transformed_vertices, indices = version.getTransformedMesh(self._preprocess_memory_limit)
+                try:
+                    result = self._tweak(node, transformed_vertices, indices, tweak_arguments, progress_callback=self.updateProgress,
+                                         prepared=self._prepared.get(node))
+                except TweakCancelled:
+                    if self._cancel_token.is_set():
+                        raise
+                    self._logStale(node)  # Move on to the next node
+                    continue
+                if self._cache is not None:
+                    self._cache.put(cache_key, result)
+
+                orientations[node] = self._orientation(result)
 
             Job.yieldThread()
-        op.push()
+        return orientations
+
+    def _calculateParallel(self, nodes: List[SceneNode], tweak_arguments: Dict[str, Any], worker_count: int) -> Dict[SceneNode, Dict[str, Any]]:
+        """Runs the Tweaker for each node in a pool of worker processes.
+
+        The progress of all workers is combined into the progress of this job.
+        """
+        pool = _importWorkerModule().OrientationPool(min(worker_count, len(nodes)), len(nodes))
+        orientations = {}  # type: Dict[SceneNode, Dict[str, Any]]
+        tasks = {}
+        try:
+            for index, node in enumerate(nodes):
+                version = self._takeVersion(node)
+                cache_key, cached_result = self._lookUp(version, tweak_arguments)
+                if cached_result is not None:
+                    Logger.log("i", "Orientation of {name} was found in the cache".format(name = node.getName()))
+                    orientations[node] = self._cachedOrientation(cached_result)
+                    pool.setProgress(index, 100)
+                    continue
+                if node in self._prepared:  # Only the scoring is left, which is not worth sending the mesh over
+                    try:
+                        result = self._tweak(node, None, None, tweak_arguments, prepared = self._prepared[node])
+                    except TweakCancelled:
+                        if self._cancel_token.is_set():
+                            raise
+                        self._logStale(node)
+                        pool.setProgress(index, 100)
+                        continue
+                    if self._cache is not None:
+                        self._cache.put(cache_key, result)
+                    orientations[node] = self._orientation(result)
+                    pool.setProgress(index, 100)
+                    continue
+
+                transformed_vertices, indices = version.getTransformedMesh(self._preprocess_memory_limit)
+                future = pool.submit(index, transformed_vertices, indices, **tweak_arguments)
+                tasks[future] = (index, node, cache_key)
+
+            running = set(tasks)
+            while running:
+                if self._cancel_token.is_set():
+                    pool.cancel()
+                    raise TweakCancelled()
+                for future in running:
+                    index, node, cache_key = tasks[future]
+                    if not self._versions[node].isCurrent():
+                        pool.cancel(index)  # The worker moves on to the next node
+                done, running = wait(running, timeout = 0.1)
+                for future in done:
+                    index, node, cache_key = tasks[future]
+                    try:
+                        result = future.result()
+                    except CancelledError:
+                        result = None
+                    if result is None:  # The task was cancelled
+                        if self._cancel_token.is_set():
+                            pool.cancel()
+                            raise TweakCancelled()
+                        self._logStale(node)
+                        pool.setProgress(index, 100)
+                        continue
+                    self._logStats(node, result)
+                    if self._cache is not None:
+                        self._cache.put(cache_key, result)
+                    orientations[node] = self._orientation(result)
+                    pool.setProgress(index, 100)
+                self.updateProgress(pool.getProgress())
+        finally:
+            pool.shutdown()
+        return orientations
+
+    def _groupCopies(self) -> Tuple[List[SceneNode], Dict[SceneNode, Tuple[SceneNode, numpy.ndarray]]]:
+        """Groups the nodes that share their mesh data and whose transformations only differ by a rotation, like the
+        copies of Multiply Selected.
+
+        Only the first node of each group is oriented, the orientation of the others follows from it by the rotation.
+        :return: The nodes to orient, and for each other node the node it is a copy of and the rotation from that node.
+        """
+        nodes = []  # type: List[SceneNode]
+        copies = {}  # type: Dict[SceneNode, Tuple[SceneNode, numpy.ndarray]]
+        groups = {}  # type: Dict[int, List[Tuple[SceneNode, numpy.ndarray]]]
+        for node in self._nodes:
+            group = groups.setdefault(id(node.getMeshData()), [])
+            transformation = node.getWorldTransformation().getData()[:3, :3]
+            for original, original_transformation in group:
+                try:
+                    rotation = numpy.dot(transformation, numpy.linalg.inv(original_transformation))
+                except numpy.linalg.LinAlgError:
+                    continue
+                if numpy.allclose(numpy.dot(rotation, rotation.T), numpy.identity(3), atol = 1e-6) and numpy.linalg.det(rotation) > 0:
+                    if self._takeVersion(node).isCurrent():  # Else it was discarded already, it is not oriented
+                        copies[node] = (original, rotation)
+                    break
+            else:
+                group.append((node, transformation))
+                nodes.append(node)
+        if copies:
+            Logger.log("i", "Orienting {count} objects by rotating the orientation of {original_count} others".format(
+                count = len(copies), original_count = len(nodes)))
+        return nodes, copies
+
+    @staticmethod
+    def _orientation(result: Tweak) -> Dict[str, Any]:
+        return {"euler_parameter": result.euler_parameter, "alignment": result.alignment}
+
+    @staticmethod
+    def _cachedOrientation(cached_result: Dict[str, Any]) -> Dict[str, Any]:
+        return {"euler_parameter": cached_result["euler_parameter"], "alignment": cached_result["best_5"][0][0]}
+
+    @staticmethod
+    def _rotateOrientation(orientation: Dict[str, Any], rotation: numpy.ndarray, tweak_arguments: Dict[str, Any]) -> Dict[str, Any]:
+        """The orientation of a copy of a node, whose mesh is the mesh of the node rotated by the rotation.
+
+        Rotating a mesh rotates the alignment the Tweaker finds for it, so the alignment of the copy is the rotated
+        alignment, which is turned downwards the same way as the Tweaker does it.
+        """
+        if numpy.allclose(rotation, numpy.identity(3), atol = 1e-9):  # Copies are mostly only moved
+            return orientation
+        alignment = numpy.dot(rotation, numpy.asarray(orientation["alignment"], dtype = numpy.float64))
+        parameter = tweak_arguments.get("parameter") or (PARAMETER_VOL if tweak_arguments.get("min_volume") else PARAMETER)
+        axis, phi, _ = euler_rotation(alignment, abs(parameter["VECTOR_TOL"]))
+        return {"euler_parameter": [axis, phi], "alignment": alignment}
+
+    def _tweak(self, node: SceneNode, vertices: Optional["numpy.ndarray"], indices: Optional["numpy.ndarray"],
+               tweak_arguments: Dict[str, Any], **kwargs: Any) -> Tweak:
+        """Runs the Tweaker for a node, profiled if the profile preference is set, and logs its statistics."""
+        profiler = cProfile.Profile() if self._profile_directory is not None else None
+        if profiler is not None:
+            profiler.enable()
+        try:
+            result = Tweak(vertices, indices = indices, cancel_token = NodeCancelToken(self._cancel_token, self._versions[node]),
+                           **kwargs, **tweak_arguments)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._dumpProfile(node, profiler)
+        self._logStats(node, result)
+        return result
+
+    def _dumpProfile(self, node: SceneNode, profiler: cProfile.Profile) -> None:
+        try:
+            os.makedirs(self._profile_directory, exist_ok = True)
+            file_name = "{time}_{name}.prof".format(time = time.strftime("%Y%m%d-%H%M%S"), name = re.sub(r"[^\w.-]", "_", node.getName()))
+            path = os.path.join(self._profile_directory, file_name)
+            profiler.dump_stats(path)
+            Logger.log("i", "Wrote the profile of the orientation of {name} to {path}".format(name = node.getName(), path = path))
+        except OSError:
+            Logger.logException("w", "Could not write the profile of the orientation of {name}".format(name = node.getName()))
+
+    def _logStats(self, node: SceneNode, result: Tweak) -> None:
+        Logger.log("i", "Orientation of {name}: {stats}".format(name = node.getName(), stats = result.stats.summary()))
+        if result.stats.lod_winner_changed is not None:
+            self._lod_winner_changes.append(result.stats.lod_winner_changed)
+
+    @staticmethod
+    def _logStale(node: SceneNode) -> None:
+        Logger.log("i", "{name} was changed or deleted while it was being oriented, its orientation is discarded".format(name = node.getName()))
+
+    def _takeVersion(self, node: SceneNode) -> NodeVersion:
+        """The current version of the node, which its mesh is read from.
+
+        Indexed meshes are passed as such, so the vertices that the faces share are not expanded. The version of the
+        node is taken first, so any change while the mesh is read makes the orientation stale.
+        """
+        self._versions[node] = NodeVersion(node)
+        if node in self._discarded:
+            self._versions[node].invalidate()
+        return self._versions[node]
+
+    @staticmethod
+    def getPreprocessMemoryLimit() -> Optional[int]:
+        """The memory in bytes the blocks of the preprocessing of a mesh may use, None processes it at once."""
+        memory = float(CuraApplication.getInstance().getPreferences().getValue("OrientationPlugin/preprocess_memory"))
+        return int(memory * 1024 * 1024) if memory > 0 else None
+
+    def _lookUp(self, version: NodeVersion, tweak_arguments: Dict[str, Any]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """Looks up the result of the mesh of the version, which does not depend on where the node is placed."""
+        if self._cache is None:
+            return None, None
+        vertices, indices = version.getLocalMesh()
+        cache_key = self._cache.createKey(vertices, tweak_arguments, indices, version.getTransformation())
+        return cache_key, self._cache.get(cache_key)
+
+    def cancel(self) -> None:
+        """Stops the calculation as soon as possible, the nodes keep their orientation."""
+        self._cancel_token.set()
+
+    def isCancelled(self) -> bool:
+        return self._cancel_token.is_set()
+
+    def discard(self, node: SceneNode) -> None:
+        """Stops orienting the node and drops its orientation, e.g. because a newer request for it was made.
+        The job moves on to its other nodes."""
+        self._discarded.add(node)  # Before the version is looked up, so _takeVersion sees one of both
+        version = self._versions.get(node)
+        if version is not None:
+            version.invalidate()
 
     def updateProgress(self, progress):
-        if self._message:
+        if self._progress_callback is not None:
+            self._progress_callback(progress)
+        elif self._message:
             self._message.setProgress(progress)
 
     def getMessage(self) -> Optional["Message"]:
-        return self._message
\ No newline at end of file
+        return self._message
@@ -2,10 +2,18 @@
 import os
 import re
 import math
+from concurrent.futures import ThreadPoolExecutor
 from time import time, sleep
-from collections import Counter
 # upgrade numpy with: "pip install numpy --upgrade"
 import numpy as np
+try:  # only needed for the hull mode
+    from scipy.spatial import ConvexHull
+except ImportError:
+    ConvexHull = None
+try:  # only needed for the compiled scoring backend
+    import numba
+except ImportError:
+    numba = None
 
 
 # These parameter were minimized by the evolutionary algorithm
@@ -54,6 +62,590 @@ PARAMETER_VOL = {
     "height_log_k": 0.3933594673063997
 }
 
+# Upper bound for the scratch memory (in bytes) used by the batched scoring of candidate orientations.
+BATCH_MEMORY_LIMIT = 256 * 1024 * 1024
+# Approximate scratch memory (in bytes) needed per face and candidate in calc_overhang_batch.
+BATCH_BYTES_PER_FACE = 128
+# The coarse mesh of the level of detail mode needs at least this amount of faces, otherwise all faces are used.
+LOD_MIN_FACES = 5000
+# The local refinement starts at the best few orientations with a step angle (in degrees) that is halved whenever
+# none of the orientations around the current one is better, until it falls below the minimum step.
+REFINE_STARTS = 3
+REFINE_STEP = 5.0
+REFINE_MIN_STEP = 0.25
+# Quantisation step for unit vectors, normals that differ less than this in each component share a bucket.
+NORMAL_TOLERANCE = 1e-6
+# With pruning, the first candidates are scored in full to get an unprintability to beat. The faces are scored in
+# at least this amount of blocks for the others, and after each block the candidates that can not win are dropped.
+PRUNE_SEEDS = 4
+PRUNE_BLOCKS = 8
+# Faces whose normal has an inner product below this with an orientation are compared in full to find the plafonds.
+PLAFOND_INNER = -1 + 1e-3
+# Projections of the corners of a face that differ less than this (in mm) are equal when its highest corner is chosen,
+# the last of them is the highest. The backends round the projections differently, with the tolerance they still
+# choose the same corner, and so the same contour edge, for the many faces with corners at equal heights.
+CORNER_TOLERANCE = 1e-4
+# In the hull mode, the biggest faces of the convex hull are added as resting orientations. Hull facets whose normals
+# differ less than the tolerance in each component form one face.
+HULL_CANDIDATES = 10
+HULL_TOLERANCE = 1e-3
+# Normals that are stored with the faces, e.g. in a binary STL, are used if their length is 1 within this tolerance.
+STORED_NORMAL_TOLERANCE = 1e-3
+# Upper bound for the temporary memory (in bytes) of a block of faces in preprocess, and the approximate amount of
+# temporary values (of the dtype of the Tweak) per face of a block.
+PREPROCESS_MEMORY_LIMIT = 16 * 1024 * 1024
+PREPROCESS_VALUES_PER_FACE = 32
+# The compiled backend adds up the sums of parts of this amount of faces in parallel, and the parts in order. The
+# parts do not depend on the amount of threads, so neither do the results. A call scores the faces of a chunk of
+# candidates in blocks of at most about this amount of face and candidate pairs, and can be cancelled in between.
+FUSED_PART_FACES = 4096
+FUSED_BLOCK_PAIRS = 2 ** 24
+# The NumpyBackend only scores a mesh in several threads if it has at least this amount of faces, smaller meshes are
+# scored faster in one.
+THREAD_MIN_FACES = 20000
+# The kernels of the compiled backend are compiled at their first use in each process, which takes several seconds.
+# The automatic backend choice only uses them for meshes with at least this amount of faces, where they make up for
+# it, unless they are already compiled.
+NUMBA_MIN_FACES = 2000000
+
+
+def quantize_normals(normals, tolerance=NORMAL_TOLERANCE):
+    """Quantises unit vectors onto a grid with the given step width and packs
+    the three grid coordinates into a single integer key.
+    Args:
+        normals (np.array): with format n x 3, each component within [-1, 1].
+        tolerance (float): the grid step width, at least 1e-6 so that the keys fit into int64.
+    Returns:
+        keys (np.array): int64 array of length n, equal keys mean equal grid cells.
+    """
+    steps = int(np.ceil(1 / tolerance))
+    base = 2 * steps + 1
+    if base ** 3 > np.iinfo(np.int64).max:
+        raise ValueError("Tolerance {} is too small to pack the quantised normals".format(tolerance))
+    grid = np.rint(np.asarray(normals) / tolerance).astype(np.int64)
+    np.clip(grid + steps, 0, 2 * steps, out=grid)
+    return (grid[:, 0] * base + grid[:, 1]) * base + grid[:, 2]
+
+
+def euler_rotation(alignment, tolerance):
+    """Calculating the euler rotation parameters and rotational matrix that turn an alignment downwards.
+    Args:
+        alignment (np.array): the alignment vector.
+        tolerance (float): alignments closer than this to the z-axis are treated as parallel to it.
+    Returns:
+        rotation axis, rotation angle, rotational matrix.
+    """
+    if np.allclose(alignment, np.array([0, 0, -1]), atol=tolerance):
+        rotation_axis = [1, 0, 0]
+        phi = np.pi
+    elif np.allclose(alignment, np.array([0, 0, 1]), atol=tolerance):
+        rotation_axis = [1, 0, 0]
+        phi = 0
+    else:
+        phi = np.pi - np.arccos(-alignment[2])
+        rotation_axis = [-alignment[1], alignment[0], 0]  # the z-axis is fixed to 0 for this rotation
+        rotation_axis = [i / np.linalg.norm(rotation_axis) for i in rotation_axis]  # normalization
+
+    v = rotation_axis
+    rotational_matrix = np.array([[v[0] * v[0] * (1 - math.cos(phi)) + math.cos(phi),
+                                   v[0] * v[1] * (1 - math.cos(phi)) - v[2] * math.sin(phi),
+                                   v[0] * v[2] * (1 - math.cos(phi)) + v[1] * math.sin(phi)],
+                                  [v[1] * v[0] * (1 - math.cos(phi)) + v[2] * math.sin(phi),
+                                   v[1] * v[1] * (1 - math.cos(phi)) + math.cos(phi),
+                                   v[1] * v[2] * (1 - math.cos(phi)) - v[0] * math.sin(phi)],
+                                  [v[2] * v[0] * (1 - math.cos(phi)) - v[1] * math.sin(phi),
+                                   v[2] * v[1] * (1 - math.cos(phi)) + v[0] * math.sin(phi),
+                                   v[2] * v[2] * (1 - math.cos(phi)) + math.cos(phi)]], dtype=np.float64)
+    # rotational_matrix = np.around(rotational_matrix, decimals=6)
+    return rotation_axis, phi, rotational_matrix
+
+
+class TweakCancelled(Exception):
+    """Raised by a Tweak whose cancel_token was set."""
+    pass
+
+
+class TweakStats:
+    """Instrumentation of a Tweak run.
+
+    Attributes:
+        phases (dict): the wall time in seconds of each phase that ran, in order. These are preprocessing,
+            area_cumulation and death_star for gathering the candidates, hull for the hull mode, coarse_selection
+            for the level of detail mode, lithography for scoring the candidates, refinement and evaluation.
+        input_faces (int): the amount of faces of the input mesh.
+        faces (int): the amount of faces left after removing those without area and those smaller than
+            NEGL_FACE_SIZE.
+        candidates (int): the amount of gathered candidate orientations.
+        scored (int): the amount of candidates scored on the full mesh in the lithography phase.
+        timed_out (bool): whether the time budget ran out, so not all candidates were scored or refined.
+        pruned (int): the amount of those candidates that were dropped part-way.
+        refined (int): the amount of orientations scored by the refinement.
+        prepared (bool): whether the candidates were gathered by an earlier Tweak with prepare_only.
+        backend (str): the name of the scoring backend.
+        lod_winner_changed (bool): in the level of detail mode with lod_verify, whether the coarse ranking missed
+            the best orientation of the full mesh. None if it was not verified.
+    """
+
+    def __init__(self):
+        self.phases = dict()
+        self.input_faces = 0
+        self.faces = 0
+        self.candidates = 0
+        self.scored = 0
+        self.pruned = 0
+        self.refined = 0
+        self.timed_out = False
+        self.prepared = False
+        self.backend = None
+        self.lod_winner_changed = None
+        self._lap_start = time()
+
+    def lap(self, phase):
+        """Adds the time since the previous lap to the given phase."""
+        now = time()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._lap_start
+        self._lap_start = now
+
+    @property
+    def total_time(self):
+        return sum(self.phases.values())
+
+    @property
+    def candidate_time(self):
+        """The mean time in seconds to score one candidate on the full mesh."""
+        return self.phases.get("lithography", 0.0) / self.scored if self.scored else 0.0
+
+    def as_dict(self):
+        return {"phases": dict(self.phases), "total_time": self.total_time, "input_faces": self.input_faces,
+                "faces": self.faces, "candidates": self.candidates, "scored": self.scored, "pruned": self.pruned,
+                "refined": self.refined, "candidate_time": self.candidate_time, "prepared": self.prepared,
+                "timed_out": self.timed_out, "backend": self.backend, "lod_winner_changed": self.lod_winner_changed}
+
+    def summary(self):
+        """A single line with the most important numbers, e.g. for a log."""
+        return ("{faces} of {input_faces} faces, {candidates} candidates ({pruned} pruned, {refined} refined), "
+                "{total:.3f} s ({phases}), {per_candidate:.2f} ms per candidate{prepared}{timed_out}{lod}").format(
+            faces=self.faces, input_faces=self.input_faces, candidates=self.candidates, pruned=self.pruned,
+            refined=self.refined, total=self.total_time,
+            phases=", ".join("{} {:.3f} s".format(phase, duration) for phase, duration in self.phases.items()),
+            per_candidate=self.candidate_time * 1000, prepared=", prepared" if self.prepared else "",
+            timed_out=", out of time" if self.timed_out else "",
+            lod={None: "", True: ", coarse ranking changed the winner",
+                 False: ", coarse ranking kept the winner"}[self.lod_winner_changed])
+
+
+class OrientationGrid:
+    """Buckets unit vectors into cubic grid cells for duplicate lookups in near
+    constant time. Two vectors are similar like np.allclose(vector, kept, atol=atol),
+    so only the kept vectors of the 27 cells around a vector have to be compared.
+    Args:
+        atol (float): the absolute tolerance of each component.
+        rtol (float): the relative tolerance of each component, as in np.allclose.
+    """
+
+    def __init__(self, atol, rtol=1e-5):
+        self.atol = atol
+        self.rtol = rtol
+        self.cell_size = atol + rtol  # the largest allowed difference of a component of unit vectors
+        self.cells = dict()
+
+    def _cell(self, vector):
+        return tuple(int(math.floor(component / self.cell_size)) for component in vector)
+
+    def find(self, vector):
+        """Returns a kept vector that is similar to vector, or None."""
+        x, y, z = (float(component) for component in vector)
+        cx, cy, cz = self._cell((x, y, z))
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    for kept in self.cells.get((cx + dx, cy + dy, cz + dz), ()):
+                        if (abs(x - kept[0]) <= self.atol + self.rtol * abs(kept[0]) and
+                                abs(y - kept[1]) <= self.atol + self.rtol * abs(kept[1]) and
+                                abs(z - kept[2]) <= self.atol + self.rtol * abs(kept[2])):
+                            return kept
+        return None
+
+    def add(self, vector):
+        """Keeps vector unless a similar vector was kept before.
+        Returns:
+            True if vector was kept.
+        """
+        if self.find(vector) is not None:
+            return False
+        vector = tuple(float(component) for component in vector)
+        self.cells.setdefault(self._cell(vector), []).append(vector)
+        return True
+
+
+class TweakMesh:
+    """The preprocessed mesh of the Tweaker as a structure of contiguous arrays.
+
+    The vertices are either stored for each face, or for an indexed mesh once
+    in points together with the indices of the three points of each face.
+
+    Attributes:
+        normals (np.array): normalised area vector of each face, face_count x 3.
+        vertices (np.array): the three vertices of each face, face_count x 3 x 3.
+            None for an indexed mesh.
+        area (np.array): area size of each face, face_count.
+        points (np.array): the vertices of an indexed mesh, each used by at least one face, point_count x 3.
+        faces (np.array): the indices into points of the vertices of each face, face_count x 3.
+        projections (np.array): scratch space for the vertices projected onto an orientation,
+            face_count x 3. Only allocated when used by project_vertices.
+        max (np.array): scratch space for the highest projected vertex of each face.
+        median (np.array): scratch space for the median projected vertex of each face.
+        edge_lengths (np.array): the length of the edge opposite to each vertex of each face,
+            face_count x 3. Only computed when used by opposite_edge_lengths.
+    """
+
+    def __init__(self, normals, vertices, area, points=None, faces=None):
+        self.normals = np.ascontiguousarray(normals)
+        self.vertices = np.ascontiguousarray(vertices) if vertices is not None else None
+        self.area = np.ascontiguousarray(area)
+        self.points = np.ascontiguousarray(points) if points is not None else None
+        self.faces = np.ascontiguousarray(faces) if faces is not None else None
+        self.projections = None
+        self.max = None
+        self.median = None
+        self.edge_lengths = None
+
+    def __len__(self):
+        return len(self.area)
+
+    @property
+    def dtype(self):
+        return self.normals.dtype
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays of the mesh in bytes."""
+        arrays = (self.normals, self.vertices, self.area, self.points, self.faces,
+                  self.projections, self.max, self.median, self.edge_lengths)
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def face_vertices(self, block=slice(None)):
+        """The three vertices of the faces in block, with format block_size x 3 x 3."""
+        if self.faces is None:
+            return self.vertices[block]
+        return self.points[self.faces[block]]
+
+    def face_vertex(self, faces, corners):
+        """The vertices at the given corners (0, 1 or 2) of the given faces, with format n x 3."""
+        if self.faces is None:
+            return self.vertices[faces, corners]
+        return self.points[self.faces[faces, corners]]
+
+    def project(self, orientations, block=slice(None), point_projections=None, out=None):
+        """Projects the three vertices of the faces in block onto the orientations.
+        The points of an indexed mesh are projected only once, and gathered for each face.
+        Args:
+            orientations (np.array): a single orientation with format 3, or orientation_count x 3.
+            block (slice): the faces to project.
+            point_projections (np.array): the already projected points of an indexed mesh, if available.
+            out (np.array): where to store the result, optional.
+        Returns:
+            projections (np.array): with format block_size x 3, or block_size x 3 x orientation_count.
+        """
+        if self.faces is None:
+            return np.matmul(self.vertices[block], orientations.T, out=out)
+        if point_projections is None:
+            point_projections = np.matmul(self.points, orientations.T)
+        return np.take(point_projections, self.faces[block], axis=0, out=out)
+
+    def allocate_scratch(self):
+        """Allocates the scratch arrays of project_vertices, if not already done."""
+        if self.projections is None:
+            self.projections = np.empty((len(self), 3), dtype=self.dtype)
+            self.max = np.empty(len(self), dtype=self.dtype)
+            self.median = np.empty(len(self), dtype=self.dtype)
+
+    def opposite_edge_lengths(self, block_size=65536):
+        """The length of the edge opposite to each vertex of each face, computed once in blocks.
+        The contour of a face is the edge between its two lowest vertices, which is the edge
+        opposite to its highest vertex.
+        Returns:
+            edge_lengths (np.array): with format face_count x 3.
+        """
+        if self.edge_lengths is None:
+            self.edge_lengths = np.empty((len(self), 3), dtype=self.dtype)
+            for start in range(0, len(self), block_size):
+                vertices = self.face_vertices(slice(start, start + block_size))
+                for corner in range(3):
+                    edges = vertices[:, (corner + 1) % 3, :] - vertices[:, (corner + 2) % 3, :]
+                    self.edge_lengths[start:start + block_size, corner] = np.sum(np.power(edges, 2), axis=-1) ** 0.5
+        return self.edge_lengths
+
+
+def sort_network(projections, low, high):
+    """The median and the maximum of the three projected vertices of each face, by a sorting
+    network of three compare-exchange steps that writes into the given scratch arrays.
+    Args:
+        projections (np.array): with format n x 3 or n x 3 x orientation_count.
+        low (np.array): scratch space for n or n x orientation_count values, receives the median.
+        high (np.array): scratch space like low, receives the maximum.
+    Returns:
+        median, maximum (np.array): the views low and high.
+    """
+    first, second, third = projections[:, 0], projections[:, 1], projections[:, 2]
+    np.minimum(first, second, out=low)
+    np.maximum(first, second, out=high)
+    np.maximum(low, third, out=low)
+    np.minimum(low, high, out=low)
+    np.maximum(high, third, out=high)
+    return low, high
+
+
+def highest_corner(projections):
+    """The corner (0, 1 or 2) with the highest projection of each face, the last one of the
+    projections that are equal within CORNER_TOLERANCE, so that the two other corners are the
+    lowest two of a stable sort. The compiled backend chooses the corner by the same rule.
+    Args:
+        projections (np.array): with format n x 3.
+    Returns:
+        array with the corner of each face.
+    """
+    first, second, third = projections[:, 0], projections[:, 1], projections[:, 2]
+    return np.where(third >= np.maximum(first, second) - CORNER_TOLERANCE, 2,
+                    np.where(second >= first - CORNER_TOLERANCE, 1, 0))
+
+
+class ScoringWorkspace:
+    """Scratch buffers of the batched scoring, allocated once for each Tweak and reused for
+    every block of faces and chunk of orientations. A buffer only grows when a bigger block
+    than before is requested.
+    """
+
+    def __init__(self):
+        self.buffers = dict()
+
+    def get(self, name, shape, dtype):
+        """A view with the given shape on the scratch buffer name, its content is undefined."""
+        size = int(np.prod(shape))
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or buffer.size < size:
+            buffer = self.buffers[name] = np.empty(size, dtype=dtype)
+        return buffer[:size].reshape(shape)
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.buffers.values())
+
+
+class NumpyBackend:
+    """The reference implementation of the scoring, with NumPy only. The faces are projected onto a
+    chunk of candidates at once, and the bottom, overhang and contour are calculated from the projections
+    in several passes, in blocks of faces that fit into the batch_memory_limit of the Tweak.
+
+    With more than one thread, the blocks of a mesh with at least THREAD_MIN_FACES faces are scored in
+    a pool of threads, at most one per CPU. NumPy releases the GIL in most of its loops, so the threads
+    can run in parallel, but how close to linear that scales depends on the memory bandwidth and on the
+    parts that hold the GIL. The pool is started for each chunk in the thread that runs the Tweak, which
+    also reports the progress.
+
+    Attributes:
+        threads (int): the amount of threads, None scores in the calling thread only.
+    """
+    name = "numpy"
+
+    def __init__(self, threads=None):
+        self.threads = threads
+
+    def score_chunk(self, tweak, mesh, orientations, min_volume, prune_above=None, longest_edges=None):
+        """Scores a chunk of orientations, see Tweak._calc_overhang_chunk for the arguments.
+        Returns:
+            arrays with the bottom size, overhang size and contour length of each orientation,
+            these are nan for the pruned orientations
+        """
+        threads = min(self.threads or 1, os.cpu_count() or 1)  # more threads than CPUs only add overhead
+        if threads <= 1 or len(mesh) < THREAD_MIN_FACES:
+            return tweak._calc_overhang_chunk(mesh, orientations, min_volume, prune_above=prune_above,
+                                              longest_edges=longest_edges)
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            return tweak._calc_overhang_chunk(mesh, orientations, min_volume, prune_above=prune_above,
+                                              longest_edges=longest_edges, pool=pool, threads=threads)
+
+
+def _compile(function):
+    """Compiles a kernel of the compiled backend with Numba, if it can be imported. The kernels
+    release the GIL and run their outer loop in parallel threads."""
+    if numba is None:
+        return function
+    return numba.njit(nogil=True, parallel=True)(function)
+
+
+prange = numba.prange if numba is not None else range
+
+
+@_compile
+def _fused_lowest_points(coordinates, orientations, part_size):
+    """The lowest projection of the coordinates, with format n x 3, onto each orientation."""
+    part_count = max((len(coordinates) + part_size - 1) // part_size, 1)
+    lowest = np.full((part_count, len(orientations)), np.inf)
+    for part in prange(part_count):
+        for i in range(part * part_size, min((part + 1) * part_size, len(coordinates))):
+            for j in range(len(orientations)):
+                projection = (coordinates[i, 0] * orientations[j, 0] + coordinates[i, 1] * orientations[j, 1] +
+                              coordinates[i, 2] * orientations[j, 2])
+                if projection < lowest[part, j]:
+                    lowest[part, j] = projection
+    result = np.full(len(orientations), np.inf)
+    for part in range(part_count):
+        for j in range(len(orientations)):
+            result[j] = min(result[j], lowest[part, j])
+    return result
+
+
+@_compile
+def _fused_block_sums(vertices, points, faces, normals, area, orientations, lowest, start, step, count,
+                      first_layer, ascent, height_offset, height_log, height_log_k, ov_h, extended_mode,
+                      min_volume, part_size):
+    """The sums of Tweak._overhang_block_sums of the faces start, start + step, ... (count faces) in a single
+    pass, in which each face is projected onto each orientation once. The vertices of an indexed mesh are
+    gathered from points by faces, otherwise faces is empty and vertices holds them."""
+    indexed = len(faces) > 0
+    part_count = max((count + part_size - 1) // part_size, 1)
+    partial = np.zeros((part_count, 6, len(orientations)))
+    for part in prange(part_count):
+        corners = np.empty((3, 3), dtype=normals.dtype)
+        for m in range(part * part_size, min((part + 1) * part_size, count)):
+            face = start + m * step
+            for corner in range(3):
+                for axis in range(3):
+                    corners[corner, axis] = (points[faces[face, corner], axis] if indexed
+                                             else vertices[face, corner, axis])
+            for j in range(len(orientations)):
+                x, y, z = orientations[j, 0], orientations[j, 1], orientations[j, 2]
+                first = corners[0, 0] * x + corners[0, 1] * y + corners[0, 2] * z
+                second = corners[1, 0] * x + corners[1, 1] * y + corners[1, 2] * z
+                third = corners[2, 0] * x + corners[2, 1] * y + corners[2, 2] * z
+                # the sorting network of sort_network
+                low, high = min(first, second), max(first, second)
+                median = min(max(low, third), high)
+                high = max(high, third)
+                layer_height = lowest[j] + first_layer
+
+                if high < layer_height:
+                    partial[part, 0, j] += area[face]
+                inner = normals[face, 0] * x + normals[face, 1] * y + normals[face, 2] * z
+                if inner < ascent and high > layer_height:
+                    if min_volume:
+                        height = (first + second + third) / 3 - lowest[j]
+                        weight = ((height_offset + height_log * np.log(height_log_k * height + 1)) * area[face] *
+                                  abs(inner - ascent) ** ov_h)
+                    else:
+                        weight = (inner - ascent) ** 2 * area[face]
+                    partial[part, 1, j] += weight
+                    partial[part, 2, j] += 1
+                    if extended_mode and normals[face, 0] == -x and normals[face, 1] == -y and normals[face, 2] == -z:
+                        partial[part, 3, j] += area[face]
+
+                if extended_mode and median < layer_height:
+                    # the contour is the edge opposite to the highest corner, see highest_corner
+                    highest = (2 if third >= max(first, second) - CORNER_TOLERANCE else
+                               (1 if second >= first - CORNER_TOLERANCE else 0))
+                    a, b = (highest + 1) % 3, (highest + 2) % 3
+                    partial[part, 4, j] += np.sqrt((corners[a, 0] - corners[b, 0]) ** 2 +
+                                                   (corners[a, 1] - corners[b, 1]) ** 2 +
+                                                   (corners[a, 2] - corners[b, 2]) ** 2)
+                    partial[part, 5, j] += 1
+    sums = np.zeros((6, len(orientations)))
+    for part in range(part_count):
+        sums += partial[part]
+    return sums
+
+
+class NumbaBackend:
+    """The scoring compiled by Numba. The projection, bottom, overhang, plafond and contour of each
+    face and orientation are calculated in one pass over the faces, without scratch arrays, in
+    parallel threads. The results equal those of the NumpyBackend up to rounding. The kernels are
+    compiled at their first use in a process, which takes a few seconds.
+
+    Attributes:
+        threads (int): the amount of threads, None uses all that Numba may use.
+    """
+    name = "numba"
+
+    def __init__(self, threads=None):
+        self.threads = threads
+
+    def score_chunk(self, tweak, mesh, orientations, min_volume, prune_above=None, longest_edges=None):
+        """Scores a chunk of orientations, see Tweak._calc_overhang_chunk for the arguments.
+        Returns:
+            arrays with the bottom size, overhang size and contour length of each orientation,
+            these are nan for the pruned orientations
+        """
+        if self.threads:
+            numba.set_num_threads(max(min(self.threads, numba.config.NUMBA_NUM_THREADS), 1))
+        face_count = len(mesh)
+        orientations = np.ascontiguousarray(orientations, dtype=mesh.dtype)
+        if mesh.faces is None:
+            vertices, points, faces = mesh.vertices, np.empty((0, 3), mesh.dtype), np.empty((0, 3), np.int32)
+            lowest = _fused_lowest_points(vertices.reshape(-1, 3), orientations, FUSED_PART_FACES)
+        else:
+            vertices, points, faces = np.empty((0, 3, 3), mesh.dtype), mesh.points, mesh.faces
+            lowest = _fused_lowest_points(points, orientations, FUSED_PART_FACES)
+
+        # the faces are scored in interleaved blocks, so each block is spread over the whole mesh for the pruning
+        block_count = max(int(np.ceil(face_count * len(orientations) / FUSED_BLOCK_PAIRS)), 1)
+        pruning = prune_above is not None and np.isfinite(prune_above) and face_count >= PRUNE_BLOCKS
+        if pruning:
+            block_count = max(block_count, PRUNE_BLOCKS)
+            blocks = [slice(start, None, block_count) for start in range(block_count)]
+            remaining_area = tweak._remaining_after_blocks(mesh.area, blocks)
+            remaining_contour = (tweak._remaining_after_blocks(longest_edges, blocks) if tweak.extended_mode
+                                 else np.zeros(block_count + 1))
+
+        sums = np.zeros((6, len(orientations)))
+        active = np.arange(len(orientations))
+        for i in range(block_count):
+            sums[:, active] += _fused_block_sums(
+                vertices, points, faces, mesh.normals, mesh.area, orientations[active], lowest[active],
+                i, block_count, len(range(i, face_count, block_count)), tweak.FIRST_LAY_H, tweak.ASCENT,
+                tweak.height_offset, tweak.height_log, tweak.height_log_k, float(tweak.OV_H),
+                tweak.extended_mode, min_volume, FUSED_PART_FACES)
+            if pruning and i + 1 < block_count:
+                lower_bounds = tweak._unprintability_lower_bound(sums[:, active], remaining_area[i + 1],
+                                                                 remaining_contour[i + 1], min_volume)
+                active = active[lower_bounds <= prune_above]
+                if len(active) == 0:
+                    break
+            sleep(0)  # Yield, so other threads get a bit of breathing space.
+            tweak.check_cancelled()
+
+        bottom, overhang, contour = tweak._finish_sums(sums, min_volume)
+        if len(active) < len(orientations):
+            pruned = np.ones(len(orientations), dtype=bool)
+            pruned[active] = False
+            bottom[pruned] = overhang[pruned] = contour[pruned] = np.nan
+        return bottom, overhang, contour
+
+
+BACKENDS = {"numpy": NumpyBackend, "numba": NumbaBackend}
+
+
+def scoring_backend(name=None, threads=None, faces=None):
+    """Creates the scoring backend of the given name.
+    Args:
+        name (str): "numpy", "numba", or None or "auto" for the compiled backend if Numba can be
+         imported and it pays off, see NUMBA_MIN_FACES. Without Numba, the NumpyBackend is used
+         for "numba" as well.
+        threads (int): the amount of threads, None uses all for the compiled backend and one for the
+         NumpyBackend.
+        faces (int): the amount of faces of the mesh to score, None if it is not known yet.
+    Returns:
+        the backend, a NumpyBackend or NumbaBackend.
+    """
+    if name in (None, "auto"):
+        compiled = numba is not None and len(_fused_block_sums.signatures) > 0
+        pays_off = faces is None or faces >= NUMBA_MIN_FACES or compiled
+        name = "numba" if numba is not None and pays_off else "numpy"
+    if name not in BACKENDS:
+        raise ValueError("Unknown scoring backend {}, use one of auto, {}".format(name, ", ".join(BACKENDS)))
+    if name == "numba" and numba is not None:
+        return NumbaBackend(threads)
+    return NumpyBackend(threads)
+
 
 class Tweak:
     """ The Tweaker is an auto rotate class for 3D objects.
@@ -70,10 +662,71 @@ class Tweak:
      vector with R.
     And the relative unprintability of the tweaked object. If this value is
      greater than 10, a support structure is suggested.
+
+    For an indexed mesh, content holds the shared vertices and indices the
+    three vertex indices of each face.
+
+    The mesh is preprocessed in blocks of faces whose temporary arrays stay
+    below the preprocess_memory_limit in bytes, None processes all faces at
+    once. Besides the input, only the arrays of the preprocessed mesh and the
+    area sizes of all faces are held, and the input is read block by block,
+    e.g. from a memory mapped file.
+
+    The search can be split in two: with prepare_only=True only the mesh is
+    preprocessed and the candidate orientations are gathered into .mesh and
+    .orientations. Such a Tweak can later be passed as prepared, together with
+    the same extended_mode and parameters, to only score the candidates.
+
+    In the level of detail mode, set by lod_ratio, all candidates are scored on
+    a coarse mesh with this fraction of the faces first. Only the lod_top_k best
+    of them are scored on the full mesh and returned. With lod_verify, all
+    candidates are scored on the full mesh as well, and .lod_winner_changed and
+    .stats.lod_winner_changed tell whether the coarse ranking missed the best orientation.
+
+    With a refine_budget, the best orientations are improved by a local search
+    on the sphere of directions that scores at most this amount of orientations.
+
+    With prune, candidates are dropped part-way through scoring once a lower bound
+    of their unprintability exceeds the best one found so far. The best orientation
+    is the same, but best_5 only holds the candidates that were scored in full.
+
+    The seed makes the random candidates of the extended mode reproducible.
+
+    With hull, the biggest faces of the convex hull are added as candidates. The
+    gathered candidates are all kept, so the result is never worse than without it.
+    With hull_min_support as well, the candidates the part can hardly stand on are
+    dropped, see hull_selection. This scores fewer candidates, but prefers a stable
+    stand over a low unprintability, so the best orientation can change.
+    This needs scipy, without it the candidates are kept as they are.
+
+    With a time_budget in seconds, the Tweak returns the best orientation it found
+    once the budget runs out. The candidates are scored in the order in which they
+    were gathered, which is from most to least promising: the current orientation,
+    the biggest hull faces in the hull mode, the biggest areas, the most common
+    random normals and the supplements. The extended search, the scoring and the refinement each stop at
+    the deadline, the current orientation is always scored. .stats.scored tells how
+    many candidates were scored, and .stats.timed_out whether the budget ran out.
+
+    The candidates are scored by a backend, which is given by its name or as an
+    object with a score_chunk method, see scoring_backend. By default the
+    NumbaBackend is used if Numba can be imported and the mesh is big enough to
+    make up for compiling it, otherwise the NumpyBackend.
+    threads sets the amount of threads the backend scores a mesh in, see
+    scoring_backend. The progress is still reported from the calling thread.
+
+    The timings and counts of the run are kept in .stats, a TweakStats.
+
+    A cancel_token is any object with an is_set() method, like a threading.Event.
+    The Tweak checks it between the stages and the chunks of the scoring, and raises
+    TweakCancelled once it is set.
     """
 
     def __init__(self, content, extended_mode=False, verbose=True, show_progress=False,
-                 favside=None, min_volume=False, parameter=None,  progress_callback=None):
+                 favside=None, min_volume=False, parameter=None,  progress_callback=None,
+                 batch_memory_limit=BATCH_MEMORY_LIMIT, dtype=np.float64, prepared=None, prepare_only=False,
+                 lod_ratio=None, lod_top_k=5, lod_verify=False, refine_budget=0, indices=None, prune=False,
+                 cancel_token=None, seed=None, hull=False, hull_min_support=0, time_budget=None, backend=None,
+                 preprocess_memory_limit=PREPROCESS_MEMORY_LIMIT, threads=None):
         # Load parameters
         if parameter is None:
             if min_volume:
@@ -90,58 +743,117 @@ class Tweak:
             self.OV_H = 1
 
         self.progress_callback = progress_callback
+        self.cancel_token = cancel_token
         self.extended_mode = extended_mode
         self.show_progress = show_progress
+        self.batch_memory_limit = batch_memory_limit
+        self.dtype = np.dtype(dtype)
         z_axis = -np.array([0, 0, 1], dtype=np.float64)
         orientations = [[z_axis, 0.0]]
 
         # Preprocess the input mesh format.
-        t_start = time()
+        self.stats = TweakStats()
+        self.deadline = time() + time_budget if time_budget else None
+        self.workspace = ScoringWorkspace()
+        self.thread_workspaces = [self.workspace]
         self._progress = 0  # progress in percent of tweaking
         self.update_progress(self._progress + 18)
-        # Load mesh from file into class variable
-        self.mesh = self.preprocess(content)
-
-        # if a favoured side is specified, load it to weight
-        if favside:
-            self.favour_side(favside)
-        t_pre = time()
-        self.update_progress(self._progress + 18)
-        # Searching promising orientations:
-        orientations += self.area_cumulation(10)
-
-        t_areacum = time()
-        self.update_progress(self._progress + 18)
-        if extended_mode:
-            orientations += self.death_star(12)
-            orientations += self.add_supplements()
-            orientations = self.remove_duplicates(orientations)
+        if prepared is None:
+            # Load mesh from file into class variable
+            self.mesh = self.preprocess(content, indices, memory_limit=preprocess_memory_limit)
+
+            # if a favoured side is specified, load it to weight
+            if favside:
+                self.favour_side(favside)
+            self.stats.lap("preprocessing")
+            self.update_progress(self._progress + 18)
+            # Searching promising orientations:
+            orientations += self.area_cumulation(10)
+
+            self.stats.lap("area_cumulation")
+            self.update_progress(self._progress + 18)
+            if extended_mode and self.out_of_time():
+                self.stats.timed_out = True
+            elif extended_mode:
+                orientations += self.death_star(12, seed)
+                orientations += self.add_supplements()
+                orientations = self.remove_duplicates(orientations)
+            self.stats.lap("death_star")
+        else:  # The mesh and the candidates were already gathered by a Tweak with prepare_only
+            self.mesh = prepared.mesh
+            orientations = list(prepared.orientations)
+            self.stats.phases = dict(prepared.stats.phases)
+            self.stats.input_faces = prepared.stats.input_faces
+            self.stats.prepared = True
+            self.stats.lap("preprocessing")
+            self.update_progress(self._progress + 36)
+        self.stats.faces = len(self.mesh)
+        self.stats.candidates = len(orientations)
+        self.backend = backend if hasattr(backend, "score_chunk") else scoring_backend(backend, threads, len(self.mesh))
+        self.stats.backend = self.backend.name
+
+        if prepare_only:
+            self.orientations = orientations
+            return
+
+        if hull:
+            orientations = self.hull_selection(orientations, min_support=hull_min_support)
+            self.stats.candidates = len(orientations)
+            self.stats.lap("hull")
 
         if verbose:
+            print("Mesh with {} faces uses {:.1f} MB".format(len(self.mesh), self.mesh.nbytes / 2 ** 20))
             print("Examine {} orientations:".format(len(orientations)))
             print("  %-26s %-10s%-10s%-10s%-10s " %
                   ("Alignment:", "Bottom:", "Overhang:", "Contour:", "Unpr.:"))
 
-        t_ds = time()
         self.update_progress(self._progress + 18)
-        # Calculate the unprintability for each orientation found in the gathering algorithms
+        # Calculate the unprintability for all orientations found in the gathering algorithms at once
         results = list()
-        for side in orientations:
-            orientation = -1 * np.array(side[0], dtype=np.float64)
-
-            self.project_vertices(orientation)
-            bottom, overhang, contour = self.calc_overhang(orientation, min_volume=min_volume)
-            unprintability = self.target_function(bottom, overhang, contour, min_volume=min_volume)
-            results.append([orientation, bottom, overhang, contour, unprintability])
+        alignments = -1 * np.array([side[0] for side in orientations], dtype=np.float64)
+        self.lod_winner_changed = None
+        if lod_ratio and len(self.mesh) * lod_ratio >= LOD_MIN_FACES and len(alignments) > lod_top_k:
+            alignments = self.coarse_selection(alignments, lod_ratio, lod_top_k, min_volume, verify=lod_verify)
+            if verbose:
+                print("Kept {} orientations after scoring on the coarse mesh".format(len(alignments)))
+            self.stats.lap("coarse_selection")
+        bottoms, overhangs, contours = self.calc_overhang_batch(alignments, min_volume=min_volume,
+                                                                prune=prune and self.can_prune(),
+                                                                deadline=self.deadline)
+        unprintabilities = self.target_function(bottoms, overhangs, contours, min_volume=min_volume)
+        self.stats.scored = len(bottoms)
+        if len(bottoms) < len(alignments):
+            self.stats.timed_out = True
+            if verbose:
+                print("Scored {} of {} orientations before the time budget ran out".format(len(bottoms),
+                                                                                          len(alignments)))
+            alignments = alignments[:len(bottoms)]
+        self.stats.pruned = int(np.sum(np.isnan(unprintabilities)))
+        if verbose and self.stats.pruned:
+            print("Pruned {} orientations that can not beat the best one".format(self.stats.pruned))
+        for i, orientation in enumerate(alignments):
+            if np.isnan(unprintabilities[i]):  # pruned
+                continue
+            results.append([orientation, bottoms[i], overhangs[i], contours[i], unprintabilities[i]])
             if verbose:
                 print("  %-26s %-10.2f%-10.2f%-10.2f%-10.4g "
                       % (str(np.around(orientation, decimals=4)),
-                         bottom, overhang, contour, unprintability))
-        t_lit = time()
+                         bottoms[i], overhangs[i], contours[i], unprintabilities[i]))
+        self.stats.lap("lithography")
+        if refine_budget > 0:
+            refined = self.refine(results, refine_budget, min_volume)
+            results += refined
+            if verbose:
+                for orientation, bottom, overhang, contour, unprintability in refined:
+                    print("  %-26s %-10.2f%-10.2f%-10.2f%-10.4g (refined)"
+                          % (str(np.around(orientation, decimals=4)), bottom, overhang, contour, unprintability))
+            self.stats.lap("refinement")
         self.update_progress(self._progress + 18)
 
-        # Remove the mesh structure as soon as it is not used anymore
+        # Remove the mesh structure and the scratch buffers as soon as they are not used anymore
         del self.mesh
+        del self.workspace
+        del self.thread_workspaces
 
         # evaluate the best alignments and calculate the rotation parameters
         results = np.array(results, dtype=object)
@@ -151,16 +863,20 @@ class Tweak:
             best_results[i] = list(best_results[i])
             v, phi, matrix = self.euler(align)
             best_results[i].append([[v[0], v[1], v[2]], phi, matrix])
+        self.stats.lap("evaluation")
 
         if verbose:
+            phases = self.stats.phases
             print("""Time-stats of algorithm:
     Preprocessing:    \t{pre:2f} s
     Area Cumulation:  \t{ac:2f} s
     Death Star:       \t{ds:2f} s
     Lithography Time:  \t{lt:2f} s
     Total Time:        \t{tot:2f} s""".format(
-                pre=t_pre - t_start, ac=t_areacum - t_pre, ds=t_ds - t_areacum,
-                lt=t_lit - t_ds, tot=t_lit - t_start))
+                pre=phases.get("preprocessing", 0), ac=phases.get("area_cumulation", 0),
+                ds=phases.get("death_star", 0),
+                lt=sum(phases.get(phase, 0) for phase in ("coarse_selection", "lithography", "refinement")),
+                tot=self.stats.total_time))
 
         # The list best_5_results is of the form:
         # [[orientation0, bottom_area0, overhang_area0, contour_line_length, unprintability (gives the order),
@@ -183,6 +899,7 @@ class Tweak:
     def target_function(self, bottom, overhang, contour, min_volume):
         """This function returns the Unprintability for a given set of bottom
         overhang area and bottom contour length, based on an ordinal scale.
+        All values may also be given as arrays to evaluate several orientations at once.
         Args:
             bottom (float): bottom area size.
             overhang (float): overhanging area size.
@@ -191,62 +908,131 @@ class Tweak:
         Returns:
             a value for the unprintability. The smaller, the better."""
         if min_volume:  # minimize the volume of support material
-            overhang /= 25  # a volume is of higher dimension, so the overhang have to be reduced
+            overhang = overhang / 25  # a volume is of higher dimension, so the overhang have to be reduced
             return (self.TAR_A * (overhang + self.TAR_B) + self.RELATIVE_F * (overhang + self.TAR_C) /
                          (self.TAR_D + self.CONTOUR_F * contour + self.BOTTOM_F * bottom + self.TAR_E * overhang))
         else:
             return (self.TAR_A * (overhang + self.TAR_B) + self.RELATIVE_F *
                     (overhang + self.TAR_C) / (self.TAR_D + self.CONTOUR_F * contour + self.BOTTOM_F * bottom))
 
-    def preprocess(self, content):
+    def preprocess(self, content, indices=None, memory_limit=None):
         """The Mesh format gets preprocessed for a better performance and stored into self.mesh
+        The faces are processed in two passes over blocks of faces. The first one calculates the
+        area sizes, the second one writes the normalised area vectors, the area sizes and the
+        vertices of the remaining faces into arrays of their final size. So the input is never
+        copied as a whole, and the area vectors of all faces are never held at once.
         Args:
-            content (np.array): undefined representation of the mesh
+            content (np.array): undefined representation of the mesh, either a vertex list
+             with format (face_count * 3) x 3 or faces with format face_count x 4 x 3 that
+             are prefixed with their normal, like the records of a binary STL. The latter may
+             be a strided view of a memory mapped file, it is not copied as a whole.
+            indices (np.array): for an indexed mesh, the indices into content of the vertices
+             of each face, with format face_count x 3. Content holds the shared vertices then.
+            memory_limit (int): the temporary arrays of a block take at most about this amount
+             of bytes, None processes all faces in a single block.
         Returns:
-            mesh (np.array): with format face_count x 6 x 3.
+            mesh (TweakMesh): with the normals, vertices and area size of each face in self.dtype.
         """
-        mesh = np.array(content, dtype=np.float64)
-
-        # prefix area vector, if not already done (e.g. in STL format)
-        if mesh.shape[1] == 3:
-            row_number = int(len(content) / 3)
-            mesh = mesh.reshape(row_number, 3, 3)
-            v0 = mesh[:, 0, :]
-            v1 = mesh[:, 1, :]
-            v2 = mesh[:, 2, :]
-            normals = np.cross(np.subtract(v1, v0), np.subtract(v2, v0)) \
-                .reshape(row_number, 1, 3)
-            mesh = np.hstack((normals, mesh))
-
-        # saves the amount of facets
-        face_count = mesh.shape[0]
-
-        # append columns with a_min, area_size
-        addendum = np.zeros((face_count, 2, 3))
-        addendum[:, 0, 0] = mesh[:, 1, 2]
-        addendum[:, 0, 1] = mesh[:, 2, 2]
-        addendum[:, 0, 2] = mesh[:, 3, 2]
+        mesh = np.asarray(content)  # only the remaining faces are converted to self.dtype
+        stored_normals = None
+        if indices is not None:
+            mesh = mesh.astype(self.dtype, copy=False)
+            faces = np.asarray(indices).reshape(-1, 3)
+            face_count = len(faces)
+
+            def face_vertices(block):
+                return mesh[faces[block]]
+        else:
+            # faces that are prefixed with their normal, or a vertex list
+            records = mesh.ndim == 3 and mesh.shape[1] == 4
+            vertices = mesh[:, 1:4, :] if records else mesh.reshape(-1, 3, 3)
+            if records:
+                stored_normals = mesh[:, 0, :]
+            face_count = len(vertices)
+
+            def face_vertices(block):
+                return np.asarray(vertices[block], dtype=self.dtype)
+
+        block_size = face_count
+        if memory_limit is not None:
+            block_size = int(max(memory_limit // (PREPROCESS_VALUES_PER_FACE * self.dtype.itemsize), 1))
+        blocks = [slice(start, start + block_size) for start in range(0, face_count, block_size)]
+
+        def area_vectors(block):
+            corners = face_vertices(block)
+            v0 = corners[:, 0, :]
+            return corners, np.cross(np.subtract(corners[:, 1, :], v0), np.subtract(corners[:, 2, :], v0))
 
         # calc area size
-        addendum[:, 1, 0] = np.sqrt(np.sum(np.square(mesh[:, 0, :]), axis=-1)).reshape(face_count)
-        addendum[:, 1, 1] = np.max(mesh[:, 1:4, 2], axis=1)
-        addendum[:, 1, 2] = np.median(mesh[:, 1:4, 2], axis=1)
-        mesh = np.hstack((mesh, addendum))
+        area = np.empty(face_count, dtype=self.dtype)
+        valid = np.empty(face_count, dtype=bool) if stored_normals is not None else None
+        for block in blocks:
+            _, normals = area_vectors(block)
+            area[block] = np.sqrt(np.sum(np.square(normals), axis=-1))
+            if stored_normals is not None:
+                # zero, invalid or flipped stored normals are replaced by the normalised cross product
+                stored_length = np.sqrt(np.sum(np.square(stored_normals[block], dtype=self.dtype), axis=-1))
+                valid[block] = (np.abs(stored_length - 1) < STORED_NORMAL_TOLERANCE) & (
+                    np.einsum("ij,ij->i", stored_normals[block], normals, dtype=self.dtype) > 0)
+            del normals
+            sleep(0)  # Yield, so other threads get a bit of breathing space.
+            self.check_cancelled()
+        self.stats.input_faces = face_count
 
         # filter faces without area
-        mesh = mesh[mesh[:, 5, 0] != 0]
-        face_count = mesh.shape[0]
-
-        # normalise area vector and correct area size
-        mesh[:, 0, :] = mesh[:, 0, :] / mesh[:, 5, 0].reshape(face_count, 1)
-        mesh[:, 5, 0] = mesh[:, 5, 0] / 2  # halve, because areas are triangles and not parallelograms
+        keep = area != 0
 
         # remove small facets (these are essential for contour calculation)
         if self.NEGL_FACE_SIZE > 0:
             negl_size = [0.1 * x if self.extended_mode else x for x in [self.NEGL_FACE_SIZE]][0]
-            filtered_mesh = mesh[np.where(mesh[:, 5, 0] > negl_size)]
-            if len(filtered_mesh) > 100:
-                mesh = filtered_mesh
+            # areas are halved, because they are triangles and not parallelograms
+            not_negligible = area / 2 > negl_size
+            if np.count_nonzero(not_negligible) > 100:
+                keep = not_negligible
+
+        # normalise area vector and correct area size of the remaining faces. The area sizes are moved to the
+        # front in place, the rows of a block only move onto rows of this or of earlier blocks.
+        kept = int(np.count_nonzero(keep))
+        normals = np.empty((kept, 3), dtype=self.dtype)
+        if indices is None:
+            kept_vertices = np.empty((kept, 3, 3), dtype=self.dtype)
+        else:
+            kept_faces = np.empty((kept, 3), dtype=faces.dtype)
+        position = 0
+        for block in blocks:
+            block_keep = keep[block]
+            target = slice(position, position + int(np.count_nonzero(block_keep)))
+            corners, block_normals = area_vectors(block)
+            block_area = area[block][block_keep]
+            np.divide(block_normals[block_keep], block_area[:, np.newaxis], out=normals[target])
+            if stored_normals is not None:
+                normals[target][valid[block][block_keep]] = stored_normals[block][block_keep & valid[block]]
+            area[target] = block_area
+            if indices is None:
+                np.compress(block_keep, corners, axis=0, out=kept_vertices[target])
+            else:
+                np.compress(block_keep, faces[block], axis=0, out=kept_faces[target])
+            position = target.stop
+            del corners, block_normals, block_area
+            sleep(0)  # Yield, so other threads get a bit of breathing space.
+            self.check_cancelled()
+        del keep, valid
+        area.resize(kept, refcheck=False)  # shrinks it in place, without a copy
+        area /= 2
+
+        if indices is None:
+            mesh = TweakMesh(normals, kept_vertices, area)
+        else:
+            # only keep the points of the remaining faces, so they give the lowest point of the mesh
+            faces = kept_faces
+            used = np.zeros(len(mesh), dtype=bool)
+            used[faces] = True
+            index_type = np.int32 if len(mesh) < np.iinfo(np.int32).max else np.int64
+            if not np.all(used):
+                remap = np.cumsum(used, dtype=index_type) - 1
+                faces = remap[faces]
+                mesh = mesh[used]
+            mesh = TweakMesh(normals, None, area, points=mesh, faces=faces.astype(index_type, copy=False))
 
         sleep(0)  # Yield, so other threads get a bit of breathing space.
         return mesh
@@ -257,7 +1043,7 @@ class Tweak:
         Args:
             favside (string): the favoured side  "[[0,-1,2.5],3]"
         Returns:
-            a weighted mesh or the original mesh in case of invalid input
+            weights the area of self.mesh or leaves it unchanged in case of invalid input
         """
         if isinstance(favside, str):
             try:
@@ -277,83 +1063,75 @@ class Tweak:
         print("You favour the side {} with a factor of {}".format(side, f))
 
         # Filter the aligning orientations
-        diff = np.subtract(self.mesh[:, 0, :], side)
+        diff = np.subtract(self.mesh.normals, side)
         align = np.sum(diff * diff, axis=1) < self.ANGLE_SCALE  # 0.7654, ANGLE_SCALE ist around 0.1
-        mesh_not_align = self.mesh[np.logical_not(align)]
-        mesh_align = self.mesh[align]
-        mesh_align[:, 5, 0] = f * mesh_align[:, 5, 0]  # weight aligning orientations
+        self.mesh.area[align] *= f  # weight aligning orientations
 
-        self.mesh = np.concatenate((mesh_not_align, mesh_align), axis=0)
-
-    def area_cumulation(self, best_n):
+    def area_cumulation(self, best_n, tolerance=NORMAL_TOLERANCE):
         """
         Gathering promising alignments by the accumulation of
         the magnitude of parallel area vectors.
         Args:
             best_n (int): amount of orientations to return.
+            tolerance (float): normals closer than this in each component are accumulated together.
         Returns:
             list of the common orientation-tuples.
         """
-        alignments = self.mesh[:, 0, :]
-        orient = Counter()
-        for index in range(len(self.mesh)):  # Accumulate area-vectors
-            orient[tuple(alignments[index])] += self.mesh[index, 5, 0]
-
-        top_n = orient.most_common(best_n)
+        alignments = self.mesh.normals
+        areas = self.mesh.area
+        keys = quantize_normals(alignments, tolerance)
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        bucket_areas = np.bincount(inverse.reshape(-1), weights=areas)  # Accumulate area-vectors
+
+        # Like Counter.most_common, equal areas are ordered by their first occurrence
+        top_n = [(tuple(alignments[first[i]]), bucket_areas[i])
+                 for i in np.lexsort((first, -bucket_areas))[:best_n]]
         sleep(0)  # Yield, so other threads get a bit of breathing space.
         return top_n
 
-    def death_star(self, best_n):
+    def death_star(self, best_n, seed=None):
         """
         Creating random faces by adding a random vertex to an existing edge.
         Common orientations of these faces are promising orientations for
-        placement.
+        placement. All iterations are generated at once, and the normals are
+        counted by their quantised integer keys.
         Args:
             best_n (int): amount of orientations to return.
+            seed (int): seed of the random edge choice, None draws from np.random.
         Returns:
             list of the common orientation-tuples.
         """
+        random = np.random if seed is None else np.random.default_rng(seed)
 
         # Small files need more calculations
         mesh_len = len(self.mesh)
         iterations = int(np.ceil(20000 / (mesh_len + 100)))
 
-        vertexes = self.mesh[:mesh_len, 1:4, :]
-        tot_normalized_orientations = np.zeros((iterations * mesh_len + 1, 3))
-        for i in range(iterations):
-            two_vertexes = vertexes[:, np.random.choice(3, 2, replace=False)]
-            vertex_0 = two_vertexes[:, 0, :]
-            vertex_1 = two_vertexes[:, 1, :]
-
-            # Using a linear congruency generator instead to choice pseudo
-            # random vertexes. Adding i to get more iterations.
-            vertex_2 = vertexes[(np.arange(mesh_len) * 127 + 8191 + i) % mesh_len, i % 3, :]
-            normals = np.cross(np.subtract(vertex_2, vertex_0),
-                               np.subtract(vertex_1, vertex_0))
-
-            # normalise area vector
-            lengths = np.sqrt((normals * normals).sum(axis=1)).reshape(mesh_len, 1)
-            # ignore ZeroDivisions
-            with np.errstate(divide='ignore', invalid='ignore'):
-                normalized_orientations = np.around(np.true_divide(normals, lengths),
-                                                    decimals=6)
-
-            tot_normalized_orientations[mesh_len * i:mesh_len * (i + 1)] = normalized_orientations
-            sleep(0)  # Yield, so other threads get a bit of breathing space.
-
-        # search the most common orientations
-        orientations = np.inner(np.array([1, 1e3, 1e6]), tot_normalized_orientations)
-        orient = Counter(orientations)
-        top_n = orient.most_common(best_n)
-        top_n = list(filter(lambda x: x[1] > 2, top_n))
-
-        candidate = list()
-        for sum_side, count in top_n:
-            face_unique, face_count = np.unique(tot_normalized_orientations[orientations == sum_side], axis=0,
-                                                return_counts=True)
-            candidate += [[list(face_unique[i]), count] for i, count in enumerate(face_count)]
-        # Filter non-injective singles
-        candidate = list(filter(lambda x: x[1] >= 2, candidate))
+        # each iteration uses the same two random vertexes of all faces as edge
+        edges = np.argsort(random.random((iterations, 3)), axis=1)[:, :2]
+        faces = np.tile(np.arange(mesh_len), iterations)
+        iteration = np.repeat(np.arange(iterations), mesh_len)
+        vertex_0 = self.mesh.face_vertex(faces, edges[iteration, 0])
+        vertex_1 = self.mesh.face_vertex(faces, edges[iteration, 1])
+
+        # Using a linear congruency generator instead to choice pseudo
+        # random vertexes. Adding i to get more iterations.
+        vertex_2 = self.mesh.face_vertex((faces * 127 + 8191 + iteration) % mesh_len, iteration % 3)
+        normals = np.cross(np.subtract(vertex_2, vertex_0), np.subtract(vertex_1, vertex_0))
+        del vertex_0, vertex_1, vertex_2, faces, iteration
+
+        # normalise area vector, ignore the degenerated faces
+        lengths = np.sqrt((normals * normals).sum(axis=1))
+        valid = lengths > 0
+        normals = np.around(normals[valid] / lengths[valid, np.newaxis], decimals=6)
+        self.check_cancelled()
+
+        # search the most common orientations, ties are ordered by their first appearance
+        _, first, counts = np.unique(quantize_normals(normals), return_index=True, return_counts=True)
+        order = np.lexsort((first, -counts))[:best_n]
+        order = order[counts[order] > 2]
+
+        candidate = [[list(normals[first[i]]), int(counts[i])] for i in order]
         # also add anti-parallel orientations
         candidate += [[list((-v[0][0], -v[0][1], -v[0][2])), v[1]] for v in candidate]
         return candidate
@@ -373,41 +1151,135 @@ class Tweak:
         return v
 
     @staticmethod
-    def remove_duplicates(old_orients):
+    def remove_duplicates(old_orients, kept=()):
         """Removing duplicate and similar orientations.
         Args:
             old_orients (list): list of faces
+            kept (list): orientations that are already kept, the similar ones of old_orients are removed as well.
         Returns:
             Unique orientations"""
         alpha = 5  # in degrees
         tol_angle = np.sin(alpha * np.pi / 180)
+        grid = OrientationGrid(tol_angle)
+        for i in kept:
+            grid.add(i[0])
         orientations = list()
         for i in old_orients:
-            duplicate = None
-            for j in orientations:
-                # redundant vectors have an angle smaller than
-                # alpha = arcsin(atol). atol=0.087 -> alpha = 5 degrees
-                if np.allclose(i[0], j[0], atol=tol_angle):
-                    duplicate = True
-                    break
-            if duplicate is None:
+            # redundant vectors have an angle smaller than
+            # alpha = arcsin(atol). atol=0.087 -> alpha = 5 degrees
+            if grid.add(i[0]):
                 orientations.append(i)
         return orientations
 
+    def convex_hull(self):
+        """The convex hull of the mesh, a part can only rest stably on its faces.
+        Returns:
+            the scipy ConvexHull, None if scipy is not available or the mesh is flat.
+        """
+        if ConvexHull is None:
+            return None
+        points = self.mesh.points if self.mesh.faces is not None else self.mesh.vertices.reshape(-1, 3)
+        try:
+            return ConvexHull(np.asarray(points, dtype=np.float64))
+        except (ValueError, RuntimeError):  # too few points, or all in a plane (QhullError)
+            return None
+
+    def hull_faces(self, hull, tolerance=HULL_TOLERANCE):
+        """The faces of the convex hull. The triangles of the hull are merged into faces by their normals.
+        Args:
+            hull (ConvexHull): the convex hull of the mesh, see convex_hull.
+            tolerance (float): normals closer than this in each component form one face.
+        Returns:
+            normals (np.array): the outwards pointing unit normal of each face, with format face_count x 3.
+            areas (np.array): the area of each face.
+        """
+        triangles = hull.points[hull.simplices]
+        areas = np.linalg.norm(np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]),
+                               axis=1) / 2
+        normals = hull.equations[:, :3]
+
+        _, inverse = np.unique(quantize_normals(normals, tolerance), return_inverse=True)
+        inverse = inverse.reshape(-1)
+        face_areas = np.bincount(inverse, weights=areas)
+        face_normals = np.stack([np.bincount(inverse, weights=normals[:, i] * areas) for i in range(3)], axis=1)
+        lengths = np.linalg.norm(face_normals, axis=1)
+        keep = lengths > 0
+        sleep(0)  # Yield, so other threads get a bit of breathing space.
+        return face_normals[keep] / lengths[keep, np.newaxis], face_areas[keep]
+
+    def hull_support(self, hull, orientations):
+        """The area of the convex hull within the first layer for each orientation, like the bottom area of
+        calc_overhang on the hull instead of the mesh. It is the size of the surface the part stands on, or
+        bridges over, and it is 0 if the part only stands on a point or an edge.
+        Args:
+            hull (ConvexHull): the convex hull of the mesh, see convex_hull.
+            orientations (np.array): the alignments, with format orientation_count x 3.
+        Returns:
+            array with the support area of each orientation.
+        """
+        vertices = hull.points[hull.vertices]  # only the points on the hull are projected
+        index = np.empty(len(hull.points), dtype=np.intp)
+        index[hull.vertices] = np.arange(len(hull.vertices))
+        triangles = index[hull.simplices]
+        corners = hull.points[hull.simplices]
+        areas = np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1) / 2
+
+        projections = np.matmul(vertices, np.asarray(orientations, dtype=np.float64).T)
+        highest = np.maximum(np.maximum(projections[triangles[:, 0]], projections[triangles[:, 1]]),
+                             projections[triangles[:, 2]])
+        supported = highest < np.amin(projections, axis=0) + self.FIRST_LAY_H
+        sleep(0)  # Yield, so other threads get a bit of breathing space.
+        return areas @ supported
+
+    def hull_selection(self, orientations, best_n=HULL_CANDIDATES, min_support=0):
+        """Adds the biggest faces of the convex hull as candidates, right after the current orientation,
+        which is the first one. The hull faces that are similar to a gathered candidate are dropped
+        instead of the candidate, so all gathered candidates are still scored.
+        With min_support, the candidates whose hull_support is below this fraction of the biggest one are
+        dropped, except for the current orientation. The part can hardly stand on them. On noisy scans,
+        0.01 drops half of the candidates, and about three quarters in the extended mode, but the best
+        orientation of such a part is sometimes among them, as the unprintability does not depend on the
+        support.
+        Args:
+            orientations (list): the gathered orientation-tuples.
+            best_n (int): amount of hull faces to add.
+            min_support (float): the minimum support relative to the biggest one, 0 keeps all candidates.
+        Returns:
+            list of the orientation-tuples, unchanged if the hull could not be calculated.
+        """
+        hull = self.convex_hull()
+        if hull is None:
+            return orientations
+        normals, areas = self.hull_faces(hull)
+        if len(areas) == 0:
+            return orientations
+
+        order = np.argsort(-areas, kind="stable")[:best_n]
+        candidates = [[tuple(normals[i]), areas[i]] for i in order]
+        orientations = orientations[:1] + self.remove_duplicates(candidates, kept=orientations) + orientations[1:]
+
+        if min_support > 0 and len(orientations) > 1:
+            alignments = -1 * np.array([side[0] for side in orientations[1:]], dtype=np.float64)
+            support = self.hull_support(hull, alignments)
+            orientations = orientations[:1] + [side for side, area in zip(orientations[1:], support)
+                                               if area >= min_support * support.max()]
+
+        sleep(0)  # Yield, so other threads get a bit of breathing space.
+        return orientations
+
     def project_vertices(self, orientation):
-        """Supplement the mesh array with scalars (max and median)
-        for each face projected onto the orientation vector.
+        """Fills the scratch arrays of the mesh with the vertices projected onto
+        the orientation vector and their max and median for each face.
         Args:
             orientation (np.array): with format 3 x 3.
         Returns:
             adjusted mesh.
         """
-        self.mesh[:, 4, 0] = np.inner(self.mesh[:, 1, :], orientation)
-        self.mesh[:, 4, 1] = np.inner(self.mesh[:, 2, :], orientation)
-        self.mesh[:, 4, 2] = np.inner(self.mesh[:, 3, :], orientation)
+        mesh = self.mesh
+        mesh.allocate_scratch()
+        mesh.project(orientation.astype(mesh.dtype), out=mesh.projections)
 
-        self.mesh[:, 5, 1] = np.max(self.mesh[:, 4, :], axis=1)
-        self.mesh[:, 5, 2] = np.median(self.mesh[:, 4, :], axis=1)
+        sort_network(mesh.projections, mesh.median, mesh.max)
         sleep(0)  # Yield, so other threads get a bit of breathing space.
 
     def calc_overhang(self, orientation, min_volume):
@@ -419,41 +1291,40 @@ class Tweak:
         Returns:
             the total bottom size, overhang size and contour length of the mesh
         """
-        total_min = np.amin(self.mesh[:, 4, :])
+        mesh = self.mesh
+        total_min = np.amin(mesh.projections)
 
         # filter bottom area
-        bottom = np.sum(self.mesh[np.where(self.mesh[:, 5, 1] < total_min + self.FIRST_LAY_H), 5, 0])
-        # # equal than:
-        # bottoms = mesh[np.where(mesh[:, 5, 1] < total_min + FIRST_LAY_H)]
-        # if len(bottoms) > 0: bottom = np.sum(bottoms[:, 5, 0])
-        # else: bottom = 0
+        bottom = np.sum(mesh.area[np.where(mesh.max < total_min + self.FIRST_LAY_H)])
 
         # filter overhangs
-        overhangs = self.mesh[np.where(np.inner(self.mesh[:, 0, :], orientation) < self.ASCENT)]
-        overhangs = overhangs[np.where(overhangs[:, 5, 1] > (total_min + self.FIRST_LAY_H))]
+        overhangs = np.where(np.inner(mesh.normals, orientation) < self.ASCENT)[0]
+        overhangs = overhangs[np.where(mesh.max[overhangs] > (total_min + self.FIRST_LAY_H))]
+        overhang_normals = mesh.normals[overhangs]
+        overhang_area = mesh.area[overhangs]
 
         if self.extended_mode:
-            plafond = np.sum(overhangs[(overhangs[:, 0, :] == -orientation).all(axis=1), 5, 0])
+            plafond = np.sum(overhang_area[(overhang_normals == -orientation).all(axis=1)])
         else:
             plafond = 0
 
         if len(overhangs) > 0:
             if min_volume:
-                heights = np.inner(overhangs[:, 1:4, :].mean(axis=1), orientation) - total_min
+                heights = np.inner(mesh.face_vertices(overhangs).mean(axis=1), orientation) - total_min
 
-                inner = np.inner(overhangs[:, 0, :], orientation) - self.ASCENT
-                # overhang = np.sum(heights * overhangs[:, 5, 0] * np.abs(inner * (inner < 0)) ** 2)
+                inner = np.inner(overhang_normals, orientation) - self.ASCENT
+                # overhang = np.sum(heights * overhang_area * np.abs(inner * (inner < 0)) ** 2)
                 overhang = np.sum((self.height_offset + self.height_log * np.log(self.height_log_k * heights + 1)) *
-                                  overhangs[:, 5, 0] * np.abs(inner * (inner < 0)) ** self.OV_H)
+                                  overhang_area * np.abs(inner * (inner < 0)) ** self.OV_H)
             else:
-                # overhang = np.sum(overhangs[:, 5, 0] * 2 *
+                # overhang = np.sum(overhang_area * 2 *
                 #                   (np.amax((np.zeros(len(overhangs)) + 0.5,
-                #                             - np.inner(overhangs[:, 0, :], orientation)),
+                #                             - np.inner(overhang_normals, orientation)),
                 #                            axis=0) - 0.5) ** 2)
                 # improved performance by finding maximum using the multiplication method, see:
                 # https://stackoverflow.com/questions/32109319/how-to-implement-the-relu-function-in-numpy
-                inner = np.inner(overhangs[:, 0, :], orientation) - self.ASCENT
-                overhang = 2 * np.sum(overhangs[:, 5, 0] * np.abs(inner * (inner < 0)) ** 2)
+                inner = np.inner(overhang_normals, orientation) - self.ASCENT
+                overhang = 2 * np.sum(overhang_area * np.abs(inner * (inner < 0)) ** 2)
             overhang -= self.PLAFOND_ADV * plafond
 
         else:
@@ -461,20 +1332,14 @@ class Tweak:
 
         # filter the total length of the bottom area's contour
         if self.extended_mode:
-            # contours = self.mesh[total_min+self.FIRST_LAY_H < self.mesh[:, 5, 1]]
-            contours = self.mesh[np.where(self.mesh[:, 5, 2] < total_min + self.FIRST_LAY_H)]
+            # contours = np.where(total_min + self.FIRST_LAY_H < mesh.max)[0]
+            contours = np.where(mesh.median < total_min + self.FIRST_LAY_H)[0]
 
             if len(contours) > 0:
-                conlen = np.arange(len(contours))
-                sortsc0 = np.argsort(contours[:, 4, :], axis=1)[:, 0]
-                sortsc1 = np.argsort(contours[:, 4, :], axis=1)[:, 1]
-
-                con = np.array([np.subtract(
-                    contours[conlen, 1 + sortsc0, :],
-                    contours[conlen, 1 + sortsc1, :])])
-
-                contours = np.sum(np.power(con, 2), axis=-1) ** 0.5
-                contour = np.sum(contours) + self.CONTOUR_AMOUNT * len(contours)
+                # the edge between the lowest two vertices is the one opposite to the highest vertex
+                corners = highest_corner(mesh.projections[contours])
+                contours = mesh.opposite_edge_lengths()[contours, corners]
+                contour = np.sum(contours) + self.CONTOUR_AMOUNT  # added once for a non-empty contour
             else:
                 contour = 0
         else:  # consider the bottom area as square, bottom=a**2 ^ contour=4*a
@@ -483,7 +1348,458 @@ class Tweak:
         sleep(0)  # Yield, so other threads get a bit of breathing space.
         return bottom, overhang, contour
 
+    def calc_overhang_batch(self, orientations, min_volume, mesh=None, prune=False, deadline=None):
+        """Calculating bottom and overhang area and the contour length for a set of
+        orientations at once. The faces are projected onto all orientations of a chunk in
+        a single (faces x orientations) operation, the chunks are sized so that the scratch
+        memory stays below self.batch_memory_limit. Gives the same results as calling
+        project_vertices and calc_overhang for each orientation. Each chunk is scored by
+        self.backend, the NumbaBackend scores it in one pass without scratch memory.
+        With prune, the first PRUNE_SEEDS orientations are scored in full, the others are
+        dropped part-way once they can not beat the best unprintability found so far.
+        With a deadline, the first orientation is scored on its own, and the following chunks
+        are sized to the remaining time by the time the orientations took so far. No chunk is
+        started after the deadline.
+        Args:
+            orientations (np.array): with format orientation_count x 3.
+            min_volume (bool): minimize the support material volume or supported surfaces
+            mesh (TweakMesh): the mesh to score, defaults to self.mesh.
+            prune (bool): drop the orientations that can not win, see can_prune.
+            deadline (float): the time() at which to stop scoring, None scores all orientations.
+        Returns:
+            arrays with the bottom size, overhang size and contour length of each orientation,
+            these are nan for the pruned orientations. With a deadline, the arrays only hold
+            the orientations that were scored before it, which are the first ones.
+        """
+        if mesh is None:
+            mesh = self.mesh
+        orientations = np.asarray(orientations, dtype=np.float64).reshape(-1, 3)
+        orientation_count = len(orientations)
+        face_count = len(mesh)
+        bottom = np.zeros(orientation_count)
+        overhang = np.zeros(orientation_count)
+        contour = np.zeros(orientation_count)
+        if orientation_count == 0:
+            return bottom, overhang, contour
+
+        per_orientation = BATCH_BYTES_PER_FACE * max(face_count, 1)
+        chunk_size = int(min(max(self.batch_memory_limit // per_orientation, 1), orientation_count))
+        best = np.inf
+        longest_edges = None
+        if prune:
+            longest_edges = self._longest_edges(mesh)
+        start = 0
+        started = time()
+        while start < orientation_count:
+            size = min(PRUNE_SEEDS, chunk_size) if prune and start == 0 else chunk_size
+            if deadline is not None:
+                now = time()
+                if start == 0:
+                    size = 1
+                elif now >= deadline:
+                    return bottom[:start], overhang[:start], contour[:start]
+                else:  # as many orientations as the time per orientation so far leaves room for
+                    size = int(min(size, max((deadline - now) * start / max(now - started, 1e-9), 1)))
+            end = min(start + size, orientation_count)
+            chunk = slice(start, end)
+            bottom[chunk], overhang[chunk], contour[chunk] = self.backend.score_chunk(
+                self, mesh, orientations[chunk], min_volume, prune_above=best if prune else None,
+                longest_edges=longest_edges)
+            if prune:
+                unprintabilities = self.target_function(bottom[chunk], overhang[chunk], contour[chunk], min_volume)
+                best = np.nanmin(np.append(unprintabilities, best))
+            start = end
+            sleep(0)  # Yield, so other threads get a bit of breathing space.
+            self.check_cancelled()
+        return bottom, overhang, contour
+
+    def _calc_overhang_chunk(self, mesh, orientations, min_volume, prune_above=None, longest_edges=None, pool=None,
+                             threads=1):
+        """Scores a chunk of orientations. If the projections of all faces onto the chunk do not
+        fit into the memory limit, the faces are processed in blocks and the partial sums are added up.
+        To prune, the faces are processed in at least PRUNE_BLOCKS interleaved blocks, so each block is
+        spread over the whole mesh, and the orientations that can not win are dropped after each block.
+        With a pool of threads, the memory limit is shared by the threads and the faces are split into
+        at least one block per thread. The threads score a round of a block each at a time, with a
+        workspace each, and the partial sums are added up in the order of the blocks, so the result does
+        not depend on which thread finishes first. To prune, there are PRUNE_BLOCKS rounds of a block per thread.
+        Args:
+            mesh (TweakMesh): the mesh to score.
+            orientations (np.array): with format orientation_count x 3.
+            min_volume (bool): minimize the support material volume or supported surfaces
+            prune_above (float): drop the orientations of which the unprintability is certainly higher.
+            longest_edges (np.array): the longest edge of each face, as given by _longest_edges, to prune.
+            pool (ThreadPoolExecutor): threads to score the blocks in, see NumpyBackend.
+            threads (int): the amount of threads of the pool.
+        Returns:
+            arrays with the bottom size, overhang size and contour length of each orientation,
+            these are nan for the pruned orientations
+        """
+        face_count = len(mesh)
+        block_size = int(max(self.batch_memory_limit // (BATCH_BYTES_PER_FACE * len(orientations) * threads), 1))
+        if pool is not None:
+            block_size = min(block_size, -(-face_count // threads))
+        orientations = orientations.astype(mesh.dtype)
+        blocks = [slice(start, start + block_size) for start in range(0, face_count, block_size)]
+        pruning = prune_above is not None and np.isfinite(prune_above) and face_count >= PRUNE_BLOCKS
+        if pruning:
+            block_count = max(len(blocks), PRUNE_BLOCKS * threads)
+            blocks = [slice(start, None, block_count) for start in range(block_count)]
+            remaining_area = self._remaining_after_blocks(mesh.area, blocks)
+            remaining_contour = (self._remaining_after_blocks(longest_edges, blocks) if self.extended_mode
+                                 else np.zeros(block_count + 1))
+
+        point_projections = None
+        if mesh.faces is not None:  # project each point of an indexed mesh once, the faces gather them
+            point_projections = np.matmul(mesh.points, orientations.T)
+            total_min = np.amin(point_projections, axis=0)
+
+        active = np.arange(len(orientations))
+        if len(blocks) <= 1:
+            projections = mesh.project(orientations, point_projections=point_projections,
+                                       out=self.workspace.get("projections", (face_count, 3, len(orientations)),
+                                                              mesh.dtype))
+            if point_projections is None:
+                total_min = np.amin(projections, axis=(0, 1))  # face_count x 3 x orientation_count
+            sums = self._overhang_block_sums(mesh, slice(0, face_count), orientations, total_min, min_volume,
+                                             projections=projections)
+        else:
+            # the blocks of a round are scored at once, each with its own workspace
+            map_blocks = pool.map if pool is not None else map
+            if pool is not None:
+                if self.extended_mode:
+                    mesh.opposite_edge_lengths()  # computed once, before the threads use it
+                self.thread_workspaces += [ScoringWorkspace() for _ in range(threads - len(self.thread_workspaces))]
+            workspaces = self.thread_workspaces[:threads]
+
+            block_projections = [None] * len(blocks)
+            if point_projections is None:  # a first pass finds the lowest point, a second pass accumulates the sums
+                def block_min(block, workspace):
+                    scratch = workspace.get("projections", (len(mesh.area[block]), 3, len(orientations)), mesh.dtype)
+                    projections = mesh.project(orientations, block, out=scratch)
+                    return np.amin(projections, axis=(0, 1)), projections
+
+                total_min = np.full(len(orientations), np.inf)
+                min_blocks = [slice(start, start + block_size) for start in range(0, face_count, block_size)]
+                for start in range(0, len(min_blocks), threads):
+                    round_results = list(map_blocks(block_min, min_blocks[start:start + threads], workspaces))
+                    for block_min_value, _ in round_results:
+                        total_min = np.minimum(total_min, block_min_value)
+                if len(min_blocks) <= threads and not pruning:  # a single round, its projections are kept
+                    block_projections = [projections for _, projections in round_results]
+            sums = np.zeros((6, len(orientations)))
+            for start in range(0, len(blocks), threads):
+                pruned_any = len(active) < len(orientations)
+                if pruned_any:  # only score the orientations that were not pruned
+                    round_orientations, round_min = orientations[active], total_min[active]
+                    round_points = point_projections[:, active] if point_projections is not None else None
+                else:
+                    round_orientations, round_min, round_points = orientations, total_min, point_projections
+
+                def block_sums(block, workspace, projections):
+                    return self._overhang_block_sums(mesh, block, round_orientations, round_min, min_volume,
+                                                     projections=projections, point_projections=round_points,
+                                                     workspace=workspace)
+
+                for block_sum in map_blocks(block_sums, blocks[start:start + threads], workspaces,
+                                            block_projections[start:start + threads]):
+                    if pruned_any:
+                        sums[:, active] += block_sum
+                    else:
+                        sums += block_sum
+                end = min(start + threads, len(blocks))
+                if pruning and end < len(blocks):
+                    lower_bounds = self._unprintability_lower_bound(sums[:, active], remaining_area[end],
+                                                                    remaining_contour[end], min_volume)
+                    active = active[lower_bounds <= prune_above]
+                    if len(active) == 0:
+                        break
+                sleep(0)  # Yield, so other threads get a bit of breathing space.
+                self.check_cancelled()
+
+        bottom, overhang, contour = self._finish_sums(sums, min_volume)
+        if len(active) < len(orientations):
+            pruned = np.ones(len(orientations), dtype=bool)
+            pruned[active] = False
+            bottom[pruned] = overhang[pruned] = contour[pruned] = np.nan
+        return bottom, overhang, contour
+
+    def _finish_sums(self, sums, min_volume):
+        """Turns the sums of _overhang_block_sums over all faces into the bottom size,
+        overhang size and contour length of each orientation."""
+        bottom, overhang_sum, overhang_count, plafond, contour_sum, contour_count = sums
+        overhang = overhang_sum if min_volume else 2 * overhang_sum
+        overhang = np.where(overhang_count > 0, overhang - self.PLAFOND_ADV * plafond, 0)
+
+        if self.extended_mode:  # like calc_overhang, the contour amount is added once for a non-empty contour
+            contour = contour_sum + self.CONTOUR_AMOUNT * (contour_count > 0)
+        else:  # consider the bottom area as square, bottom=a**2 ^ contour=4*a
+            contour = 4 * np.sqrt(bottom)
+        return bottom, overhang, contour
+
+    def can_prune(self):
+        """Whether the parameters keep the unprintability monotone in the partial sums, which
+        the lower bounds of the pruning rely on. This holds for the default parameters."""
+        parameters = [self.TAR_A, self.RELATIVE_F, self.CONTOUR_F, self.BOTTOM_F, self.TAR_D, self.TAR_E,
+                      self.PLAFOND_ADV, self.CONTOUR_AMOUNT, self.height_offset, self.height_log, self.height_log_k]
+        return min(parameters) >= 0 and self.TAR_D > 0 and self.TAR_D >= self.TAR_E * self.TAR_C
+
+    def _longest_edges(self, mesh):
+        """The longest edge of each face, which bounds what a face adds to the contour.
+        Args:
+            mesh (TweakMesh): the mesh to score.
+        Returns:
+            array with format face_count, or None if the contour does not depend on the edges.
+        """
+        if not self.extended_mode:
+            return None
+        return np.max(mesh.opposite_edge_lengths(), axis=1).astype(np.float64)
+
+    @staticmethod
+    def _remaining_after_blocks(values, blocks):
+        """The sums of values over the blocks from each block on, the last entry is 0."""
+        block_sums = np.array([np.sum(values[block], dtype=np.float64) for block in blocks])
+        return np.append(np.cumsum(block_sums[::-1])[::-1], 0)
+
+    def _unprintability_lower_bound(self, sums, remaining_area, remaining_contour, min_volume):
+        """A lower bound of the unprintability of each orientation, given the partial sums of the
+        faces that were scored so far. Bottom and contour can grow by at most what the remaining faces
+        add, the overhang only grows, as the weights and the plafond advantage are not negative.
+        Args:
+            sums (np.array): the partial sums of _overhang_block_sums, 6 x orientation_count.
+            remaining_area (float): the area of the faces that were not scored yet.
+            remaining_contour (float): the contour length that the faces that were not scored yet add at most.
+            min_volume (bool): minimize the support material volume or supported surfaces
+        Returns:
+            array with a lower bound of the unprintability of each orientation.
+        """
+        bottom, overhang_sum, overhang_count, plafond, contour_sum, contour_count = sums
+
+        # a remaining plafond face adds its weight to the overhang, minus the plafond advantage
+        plafond_weight = 0
+        if self.extended_mode:
+            plafond_weight = ((self.height_offset if min_volume else 2) *
+                              abs(-1 - self.ASCENT) ** (self.OV_H if min_volume else 2) - self.PLAFOND_ADV)
+        overhang = (overhang_sum if min_volume else 2 * overhang_sum) - self.PLAFOND_ADV * plafond
+        overhang += min(plafond_weight, 0) * remaining_area
+        overhang = np.where(overhang_count > 0, overhang, np.minimum(overhang, 0))
+
+        if self.extended_mode:
+            contour_low = contour_sum + self.CONTOUR_AMOUNT * (contour_count > 0)
+            contour_high = (contour_sum + remaining_contour +
+                            self.CONTOUR_AMOUNT * ((contour_count > 0) | (remaining_contour > 0)))
+        else:
+            contour_low = 4 * np.sqrt(bottom)
+            contour_high = 4 * np.sqrt(bottom + remaining_area)
+        denominator_low = self.TAR_D + self.CONTOUR_F * contour_low + self.BOTTOM_F * bottom
+        denominator_high = self.TAR_D + self.CONTOUR_F * contour_high + self.BOTTOM_F * (bottom + remaining_area)
+        if min_volume:
+            overhang = overhang / 25
+            denominator_low = denominator_low + self.TAR_E * overhang
+            denominator_high = denominator_high + self.TAR_E * overhang
+
+        # the unprintability rises with the overhang, and with the bottom and contour if the numerator is negative
+        numerator = overhang + self.TAR_C
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = np.where(numerator >= 0, numerator / denominator_high, numerator / denominator_low)
+        lower_bound = self.TAR_A * (overhang + self.TAR_B) + self.RELATIVE_F * relative
+        return np.where(denominator_low > 0, lower_bound, -np.inf)
+
+    def _overhang_block_sums(self, mesh, block, orientations, total_min, min_volume, projections=None,
+                             point_projections=None, workspace=None):
+        """Calculates the partial sums of a block of faces for each orientation of a chunk.
+        Args:
+            mesh (TweakMesh): the mesh to score.
+            block (slice): the faces of the mesh to consider.
+            orientations (np.array): with format orientation_count x 3.
+            total_min (np.array): the lowest projected vertex of the whole mesh for each orientation.
+            min_volume (bool): minimize the support material volume or supported surfaces
+            projections (np.array): the already projected vertices of the block, if available.
+            point_projections (np.array): the already projected points of an indexed mesh, if available.
+            workspace (ScoringWorkspace): the scratch buffers to use, the one of the Tweak by default.
+        Returns:
+            array with the rows bottom, overhang sum, overhang count, plafond, contour sum and contour count.
+        """
+        normals = mesh.normals[block]
+        area = mesh.area[block]
+        shape = (len(area), len(orientations))
+        workspace = workspace if workspace is not None else self.workspace
+        if projections is None:  # block_size x 3 x orientation_count
+            projections = mesh.project(orientations, block, point_projections=point_projections,
+                                       out=workspace.get("projections", (len(area), 3, len(orientations)), mesh.dtype))
+        if self.extended_mode:  # the median gives the contour
+            face_median, face_max = sort_network(projections, workspace.get("median", shape, mesh.dtype),
+                                                 workspace.get("max", shape, mesh.dtype))
+        else:
+            face_max = np.maximum(projections[:, 0], projections[:, 1], out=workspace.get("max", shape, mesh.dtype))
+            np.maximum(face_max, projections[:, 2], out=face_max)
+        layer_height = total_min + self.FIRST_LAY_H
+        sums = np.zeros((6, len(orientations)))
+        # the masks are multiplied with the areas as floats, the same as the matrix product of a boolean mask does
+        selected = workspace.get("selected", shape, mesh.dtype)
+
+        # filter bottom area
+        np.less(face_max, layer_height, out=selected)
+        sums[0] = area @ selected
+
+        # filter overhangs
+        inner = np.matmul(normals, orientations.T, out=workspace.get("inner", shape, mesh.dtype))
+        overhangs = np.less(inner, self.ASCENT, out=workspace.get("overhangs", shape, bool))
+        overhangs &= np.greater(face_max, layer_height, out=workspace.get("mask", shape, bool))
+        if self.extended_mode:
+            # a plafond faces exactly downwards, so only the overhangs with an inner product of about -1 are compared
+            candidates = np.less(inner, PLAFOND_INNER, out=workspace.get("mask", shape, bool))
+            candidates &= overhangs
+            faces, columns = np.nonzero(candidates)
+            plafonds = (normals[faces] == -orientations[columns]).all(axis=-1)
+            if np.any(plafonds):
+                selected.fill(0)
+                selected[faces[plafonds], columns[plafonds]] = 1
+                sums[3] = area @ selected
+
+        inner -= self.ASCENT
+        if min_volume:
+            # the height of the face center above the lowest point, summed up like np.mean does
+            centers = workspace.get("centers", shape, mesh.dtype)
+            np.add(projections[:, 0], projections[:, 1], out=centers)
+            centers += projections[:, 2]
+            centers /= 3
+            weights = workspace.get("weights", shape, np.result_type(mesh.dtype, total_min.dtype))
+            np.subtract(centers, total_min, out=weights)
+            weights *= self.height_log_k
+            weights += 1
+            np.log(weights, out=weights)
+            weights *= self.height_log
+            weights += self.height_offset
+            weights *= area[:, np.newaxis]
+            np.abs(inner, out=inner)
+            inner **= self.OV_H
+            weights *= inner
+        else:
+            weights = np.abs(inner, out=workspace.get("weights", shape, mesh.dtype))
+            np.square(weights, out=weights)
+            weights *= area[:, np.newaxis]
+        sums[1] = np.sum(weights, axis=0, where=overhangs)
+        sums[2] = np.sum(overhangs, axis=0)
+
+        if self.extended_mode:
+            # filter the total length of the bottom area's contour, given by the edge between the lowest two
+            # vertices, which is the edge opposite to the highest vertex
+            faces, columns = np.nonzero(np.less(face_median, layer_height, out=workspace.get("mask", shape, bool)))
+            if len(faces) > 0:
+                corners = highest_corner(projections[faces, :, columns])
+                lengths = mesh.opposite_edge_lengths()[block][faces, corners]
+                sums[4] = np.bincount(columns, weights=lengths, minlength=len(orientations))
+                sums[5] = np.bincount(columns, minlength=len(orientations))
+        return sums
+
+    def sample_mesh(self, ratio):
+        """Creates a coarse version of self.mesh by area weighted systematic sampling
+        of its faces. Big faces are picked several times and keep about their area,
+        the areas of the picked small faces are scaled up so the total area is kept.
+        Args:
+            ratio (float): the approximate fraction of faces to keep.
+        Returns:
+            mesh (TweakMesh): the coarse mesh.
+        """
+        sample_count = max(int(len(self.mesh) * ratio), 1)
+        cumulative = np.cumsum(self.mesh.area, dtype=np.float64)
+        interval = cumulative[-1] / sample_count
+        positions = (np.arange(sample_count) + 0.5) * interval
+        picked = np.minimum(np.searchsorted(cumulative, positions), len(self.mesh) - 1)
+        faces, hits = np.unique(picked, return_counts=True)
+        return TweakMesh(self.mesh.normals[faces], self.mesh.face_vertices(faces),
+                         (hits * interval).astype(self.mesh.dtype))
+
+    def coarse_selection(self, alignments, ratio, top_k, min_volume, verify=False):
+        """Scores all alignments on a coarse version of the mesh and selects the most
+        promising ones to be scored on the full mesh.
+        Args:
+            alignments (np.array): with format orientation_count x 3.
+            ratio (float): the approximate fraction of faces of the coarse mesh.
+            top_k (int): amount of alignments to keep.
+            min_volume (bool): minimize the support material volume or supported surfaces
+            verify (bool): score all alignments on the full mesh as well, and store
+             in self.lod_winner_changed whether the best one is not among the kept ones.
+        Returns:
+            the top_k alignments, best first.
+        """
+        coarse_scores = self.target_function(*self.calc_overhang_batch(alignments, min_volume,
+                                                                        mesh=self.sample_mesh(ratio)),
+                                             min_volume=min_volume)
+        selection = np.argsort(coarse_scores, kind="stable")[:top_k]
+        if verify:
+            scores = self.target_function(*self.calc_overhang_batch(alignments, min_volume), min_volume=min_volume)
+            self.lod_winner_changed = self.stats.lod_winner_changed = not np.any(scores[selection] <= np.min(scores))
+        sleep(0)  # Yield, so other threads get a bit of breathing space.
+        return alignments[selection]
+
+    def refine(self, results, budget, min_volume, starts=REFINE_STARTS):
+        """Improves the best results by a derivative-free pattern search on the
+        sphere of directions. In each step, six directions around each start are
+        scored in one batch. The search moves to the best of them if it is better,
+        otherwise the step angle is halved.
+        Args:
+            results (list): scored orientations of the form [orientation, bottom, overhang, contour, unprintability].
+            budget (int): the maximum amount of orientations to score.
+            min_volume (bool): minimize the support material volume or supported surfaces
+            starts (int): amount of best results to start a search from.
+        Returns:
+            list of the improved orientations, in the same form as results.
+        """
+        best = sorted(results, key=lambda result: result[4])[:starts]
+        current = [list(result) for result in best]
+        steps = np.full(len(current), np.radians(REFINE_STEP))
+        angles = np.linspace(0, 2 * np.pi, 6, endpoint=False)
+        evaluations = 0
+
+        while evaluations < budget:
+            active = np.nonzero(steps >= np.radians(REFINE_MIN_STEP))[0]
+            if len(active) == 0:
+                break
+            if self.out_of_time():
+                self.stats.timed_out = True
+                break
+            polls = list()
+            for i in active:
+                direction = np.asarray(current[i][0], dtype=np.float64)
+                helper = np.array([0, 0, 1.0]) if abs(direction[2]) < 0.9 else np.array([1.0, 0, 0])
+                u = np.cross(direction, helper)
+                u /= np.linalg.norm(u)
+                w = np.cross(direction, u)
+                polls.append(np.cos(steps[i]) * direction + np.sin(steps[i]) *
+                             (np.cos(angles)[:, np.newaxis] * u + np.sin(angles)[:, np.newaxis] * w))
+            polls = np.concatenate(polls)[:budget - evaluations]
+            polls /= np.linalg.norm(polls, axis=1)[:, np.newaxis]
+
+            bottoms, overhangs, contours = self.calc_overhang_batch(polls, min_volume, deadline=self.deadline)
+            evaluations += len(bottoms)
+            self.stats.refined += len(bottoms)
+            unprintabilities = self.target_function(bottoms, overhangs, contours, min_volume=min_volume)
+            for n, i in enumerate(active):
+                poll = slice(n * len(angles), (n + 1) * len(angles))
+                if len(unprintabilities[poll]) == 0:
+                    break
+                j = poll.start + np.argmin(unprintabilities[poll])
+                if unprintabilities[j] < current[i][4]:
+                    current[i] = [polls[j], bottoms[j], overhangs[j], contours[j], unprintabilities[j]]
+                else:
+                    steps[i] /= 2
+            sleep(0)  # Yield, so other threads get a bit of breathing space.
+
+        return [result for result, start in zip(current, best) if result[4] < start[4]]
+
+    def out_of_time(self):
+        """Whether the deadline of the time_budget has passed."""
+        return self.deadline is not None and time() >= self.deadline
+
+    def check_cancelled(self):
+        """Raises TweakCancelled if the cancel_token was set."""
+        if self.cancel_token is not None and self.cancel_token.is_set():
+            raise TweakCancelled()
+
     def update_progress(self, new_progress):
+        self.check_cancelled()
         self._progress = new_progress
         if self.show_progress:
             os.system('cls')
@@ -498,27 +1814,6 @@ class Tweak:
         Returns:
             rotation axis, rotation angle, rotational matrix.
         """
-        if np.allclose(bestside[0], np.array([0, 0, -1]), atol=abs(self.VECTOR_TOL)):
-            rotation_axis = [1, 0, 0]
-            phi = np.pi
-        elif np.allclose(bestside[0], np.array([0, 0, 1]), atol=abs(self.VECTOR_TOL)):
-            rotation_axis = [1, 0, 0]
-            phi = 0
-        else:
-            phi = np.pi - np.arccos(-bestside[0][2])
-            rotation_axis = [-bestside[0][1], bestside[0][0], 0]  # the z-axis is fixed to 0 for this rotation
-            rotation_axis = [i / np.linalg.norm(rotation_axis) for i in rotation_axis]  # normalization
-
-        v = rotation_axis
-        rotational_matrix = np.array([[v[0] * v[0] * (1 - math.cos(phi)) + math.cos(phi),
-                                       v[0] * v[1] * (1 - math.cos(phi)) - v[2] * math.sin(phi),
-                                       v[0] * v[2] * (1 - math.cos(phi)) + v[1] * math.sin(phi)],
-                                      [v[1] * v[0] * (1 - math.cos(phi)) + v[2] * math.sin(phi),
-                                       v[1] * v[1] * (1 - math.cos(phi)) + math.cos(phi),
-                                       v[1] * v[2] * (1 - math.cos(phi)) - v[0] * math.sin(phi)],
-                                      [v[2] * v[0] * (1 - math.cos(phi)) - v[1] * math.sin(phi),
-                                       v[2] * v[1] * (1 - math.cos(phi)) + v[0] * math.sin(phi),
-                                       v[2] * v[2] * (1 - math.cos(phi)) + math.cos(phi)]], dtype=np.float64)
-        # rotational_matrix = np.around(rotational_matrix, decimals=6)
+        rotation_axis, phi, rotational_matrix = euler_rotation(bestside[0], abs(self.VECTOR_TOL))
         sleep(0)  # Yield, so other threads get a bit of breathing space.
         return rotation_axis, phi, rotational_matrix
@@ -0,0 +1,85 @@
+# Copyright (c) 2022 Jaime van Kessel
+# The OrientationPLugin is released under the terms of the AGPLv3 or higher.
+
+from UM.Scene.SceneNode import SceneNode
+
+import numpy
+
+from typing import Optional, Tuple
+
+# Approximate temporary memory (in bytes) per vertex of a block in getTransformedMesh.
+TRANSFORM_BYTES_PER_VERTEX = 48
+
+
+class NodeVersion:
+    """The mesh and the transformation of a node at the moment an orientation is calculated from them.
+
+    The Tweaker does not depend on the position, so the version stays current while the node is moved. It becomes
+    stale once the node is deleted, gets another mesh, is rotated or scaled, or when it is invalidated, e.g. because a
+    newer request for the node was made.
+    """
+
+    def __init__(self, node: SceneNode) -> None:
+        self._node = node
+        self._mesh_data = node.getMeshData()
+        self._world_transformation = node.getWorldTransformation().getData().copy()
+        self._transformation = self._world_transformation[:3, :3].copy()
+        self._invalidated = False
+
+    def _getLinearTransformation(self) -> numpy.ndarray:
+        return self._node.getWorldTransformation().getData()[:3, :3].copy()
+
+    def getNode(self) -> SceneNode:
+        return self._node
+
+    def getTransformation(self) -> numpy.ndarray:
+        """The rotation and scale of the node in this version, without the translation."""
+        return self._transformation
+
+    def getLocalMesh(self) -> Tuple[numpy.ndarray, Optional[numpy.ndarray]]:
+        """The vertices of the mesh of this version in local coordinates, and the vertex indices of its faces if the
+        mesh is indexed."""
+        indices = self._mesh_data.getIndices() if self._mesh_data.hasIndices() else None
+        return self._mesh_data.getVertices(), indices
+
+    def getTransformedMesh(self, memory_limit: Optional[int] = None) -> Tuple[numpy.ndarray, Optional[numpy.ndarray]]:
+        """The vertices of the mesh of this version in world coordinates, and the vertex indices of its faces if the
+        mesh is indexed.
+
+        Unlike getMeshDataTransformed, the normals are not transformed, and the vertices are transformed in blocks
+        straight into the result, so no full size temporary arrays are needed.
+
+        :param memory_limit: The temporary arrays of a block take at most about this amount of bytes, None transforms
+            all vertices at once.
+        """
+        vertices, indices = self.getLocalMesh()
+        rotation = self._world_transformation[:3, :3].T
+        translation = self._world_transformation[:3, 3]
+        block_size = len(vertices) if memory_limit is None else max(memory_limit // TRANSFORM_BYTES_PER_VERTEX, 1)
+        transformed = numpy.empty(vertices.shape, dtype = vertices.dtype)
+        for start in range(0, len(vertices), block_size):
+            block = slice(start, start + block_size)
+            transformed[block] = numpy.matmul(vertices[block], rotation) + translation
+        return transformed, indices
+
+    def invalidate(self) -> None:
+        self._invalidated = True
+
+    def isCurrent(self) -> bool:
+        """Whether the node still has the mesh, rotation and scale of this version."""
+        if self._invalidated or self._node.getParent() is None:
+            return False
+        if self._node.getMeshData() is not self._mesh_data:
+            return False
+        return numpy.array_equal(self._getLinearTransformation(), self._transformation)
+
+
+class NodeCancelToken:
+    """A cancel token for the Tweaker, which is set when the job is cancelled or the node version became stale."""
+
+    def __init__(self, job_token, version: NodeVersion) -> None:
+        self._job_token = job_token
+        self._version = version
+
+    def is_set(self) -> bool:
+        return self._job_token.is_set() or not self._version.isCurrent()
@@ -0,0 +1,157 @@
+# Copyright (c) 2022 Jaime van Kessel
+# The OrientationPLugin is released under the terms of the AGPLv3 or higher.
+
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from typing import Any, Dict, Optional
+
+from .MeshTweaker import PARAMETER, PARAMETER_VOL, Tweak
+
+# Bump this when the stored results or the way they are calculated change, so old entries are no longer used.
+CACHE_VERSION = 3
+
+
+class OrientationCache:
+    """Persistent cache of orientation results on disk.
+
+    Each entry is a small json file, named after a hash of the mesh content and the settings of the Tweaker.
+    The modification time of the files is used to track their last use, the least recently used entries are
+    removed as soon as the cache grows beyond its maximum size.
+    """
+
+    def __init__(self, directory: str, max_size: int) -> None:
+        self._directory = directory
+        self._max_size = max_size  # In bytes
+        self._lock = threading.Lock()
+
+    def setMaxSize(self, max_size: int) -> None:
+        self._max_size = max_size
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def createKey(vertices: np.ndarray, tweak_arguments: Dict[str, Any], indices: Optional[np.ndarray] = None,
+                  transformation: Optional[np.ndarray] = None) -> str:
+        """Creates the key of a mesh and the settings it is oriented with.
+
+        The orientation does not depend on the position of a mesh, so a node keeps its key when it is moved: the
+        key is made from the vertices in local coordinates and only the rotation and scale of the node.
+
+        :param vertices: The vertices of the mesh, in the coordinates of the transformation.
+        :param tweak_arguments: The keyword arguments of the Tweaker that affect the result, like extended_mode and
+            min_volume. If no parameter set is given, the one the Tweaker picks for min_volume is used.
+        :param indices: The vertex indices of the faces, if the mesh is indexed.
+        :param transformation: The 3x3 rotation and scale that the Tweaker gets the vertices in, None if they are
+            passed as they are.
+        :return: A hex digest that identifies the result.
+        """
+        arguments = dict(tweak_arguments)
+        arguments.pop("verbose", None)
+        arguments.pop("backend", None)  # The backends give the same results
+        arguments.pop("preprocess_memory_limit", None)  # So does preprocessing in blocks of any size
+        arguments.pop("threads", None)  # And scoring in any amount of threads
+        arguments.pop("lod_verify", None)  # Verifying the coarse ranking does not change the result either
+        if arguments.get("parameter") is None:
+            arguments["parameter"] = PARAMETER_VOL if arguments.get("min_volume") else PARAMETER
+        arguments["parameter"] = sorted(arguments["parameter"].items())
+        vertices = np.ascontiguousarray(vertices)
+        index_layout = None
+        if indices is not None:
+            indices = np.ascontiguousarray(indices)
+            index_layout = [str(indices.dtype), indices.shape]
+        if transformation is not None:
+            transformation = np.ascontiguousarray(transformation, dtype = np.float64)
+        settings = json.dumps([CACHE_VERSION, str(vertices.dtype), vertices.shape, index_layout, sorted(arguments.items()),
+                               transformation is not None])
+
+        digest = hashlib.blake2b(digest_size = 20)
+        digest.update(settings.encode("utf-8"))
+        digest.update(memoryview(vertices).cast("B"))
+        if indices is not None:
+            digest.update(memoryview(indices).cast("B"))
+        if transformation is not None:
+            digest.update(memoryview(transformation).cast("B"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Looks up a result and marks it as recently used.
+
+        :return: A dict with the euler_parameter and the best_5 results, or None if the key is unknown.
+        """
+        path = self._getPath(key)
+        with self._lock:
+            try:
+                with open(path, "r", encoding = "utf-8") as f:
+                    entry = json.load(f)
+                os.utime(path)
+            except (OSError, ValueError):
+                return None
+        return entry
+
+    def put(self, key: str, result: Tweak) -> None:
+        """Stores the ranked results of a Tweak run. Results that were cut short by the time budget are not stored."""
+        if result.stats.timed_out:
+            return
+        entry = {
+            "euler_parameter": [[float(i) for i in result.euler_parameter[0]], float(result.euler_parameter[1])],
+            "best_5": [[[float(i) for i in alignment], float(bottom), float(overhang), float(contour),
+                        float(unprintability), [[float(i) for i in axis], float(phi), np.asarray(matrix).tolist()]]
+                       for alignment, bottom, overhang, contour, unprintability, (axis, phi, matrix)
+                       in result.best_5[:5]]
+        }
+        with self._lock:
+            try:
+                os.makedirs(self._directory, exist_ok = True)
+                path = self._getPath(key)
+                with open(path + ".tmp", "w", encoding = "utf-8") as f:
+                    json.dump(entry, f)
+                os.replace(path + ".tmp", path)
+            except OSError:
+                return
+            self._evict()
+
+    def clear(self) -> None:
+        """Removes all entries from the cache."""
+        with self._lock:
+            for name, _, _ in self._listEntries():
+                try:
+                    os.remove(os.path.join(self._directory, name))
+                except OSError:
+                    pass
+
+    def _getPath(self, key: str) -> str:
+        return os.path.join(self._directory, key + ".json")
+
+    def _listEntries(self):
+        try:
+            names = os.listdir(self._directory)
+        except OSError:
+            return []
+        entries = []
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self._directory, name))
+            except OSError:
+                continue
+            entries.append((name, stat.st_mtime, stat.st_size))
+        return entries
+
+    def _evict(self) -> None:
+        """Removes the least recently used entries until the cache fits into its maximum size."""
+        entries = sorted(self._listEntries(), key = lambda entry: entry[1])
+        total_size = sum(size for _, _, size in entries)
+        for name, _, size in entries:
+            if total_size <= self._max_size:
+                break
+            try:
+                os.remove(os.path.join(self._directory, name))
+            except OSError:
+                continue
+            total_size -= size
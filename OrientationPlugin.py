@@ -1,4 +1,10 @@
-from typing import List, cast
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, cast
+
+try:
+    from PyQt6.QtCore import QObject, pyqtSlot
+except ImportError:
+    from PyQt5.QtCore import QObject, pyqtSlot
 
 from UM.Extension import Extension
 from UM.PluginRegistry import PluginRegistry
@@ -6,12 +12,17 @@ from UM.Scene.SceneNode import SceneNode
 from UM.Scene.Selection import Selection
 
 from UM.Message import Message
+from UM.Resources import Resources
 from cura.CuraApplication import CuraApplication
 
 from cura.CuraVersion import CuraVersion  # type: ignore
 from UM.Version import Version
 
 from .CalculateOrientationJob import CalculateOrientationJob
+from .OrientationCache import OrientationCache
+from .OrientationScheduler import OrientationScheduler
+from .PrecomputeOrientationJob import PrecomputeOrientationJob
+from .MeshTweaker import Tweak
 
 from UM.i18n import i18nCatalog
 
@@ -19,9 +30,10 @@ import os
 i18n_catalog = i18nCatalog("OrientationPlugin")
 
 
-class OrientationPlugin(Extension):
-    def __init__(self):
-        super().__init__()
+class OrientationPlugin(QObject, Extension):
+    def __init__(self, parent = None) -> None:
+        QObject.__init__(self, parent)
+        Extension.__init__(self)
         self.addMenuItem(i18n_catalog.i18n("Calculate fast optimal printing orientation"), self.doFastAutoOrientation)
         self.addMenuItem(i18n_catalog.i18n("Calculate extended optimal printing orientation"), self.doExtendedAutoOrientiation)
         self.addMenuItem("", lambda: None)
@@ -29,11 +41,59 @@ class OrientationPlugin(Extension):
         self._message = None
 
         self._currently_loading_files = []  # type: List[str]
-        self._check_node_queue = []  # type: List[SceneNode]
         CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/do_auto_orientation", False)
         self._do_auto_orientation = CuraApplication.getInstance().getPreferences().getValue("OrientationPlugin/do_auto_orientation")
         # Should the volume beneath the overhangs be penalized?
         CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/min_volume", True)
+        # Results are cached on disk, so known models are oriented instantly. The size of the cache is in MB.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/use_cache", True)
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/cache_size", 10)
+        # Orient several models at once in this amount of worker processes, 1 orients them one after another.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/worker_count", 1)
+        # Score the candidate orientations of big models on a fraction of the faces first, and only the best
+        # few of them on all faces. A ratio of 0 scores all candidates on all faces.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/lod_ratio", 0)
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/lod_top_k", 5)
+        # Score all candidates on all faces as well, and log how often the coarse ranking changed the best orientation.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/lod_verify", False)
+        # Improve the best orientations by a local search that scores at most this amount of orientations, 0 is off.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/refine_budget", 0)
+        # Stop scoring the candidate orientations that can not beat the best one found so far.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/prune", False)
+        # Seed of the random candidates of the extended mode, so a model always gets the same orientation.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/seed", 0)
+        # Add the biggest faces of the convex hull as candidates.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/hull", False)
+        # In the hull mode, drop the candidates whose area on the first layer is below this fraction of the biggest one,
+        # e.g. 0.01. Fewer candidates are scored, but the part may get a higher unprintability. 0 keeps all of them.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/hull_min_support", 0)
+        # Return the best orientation found within this amount of seconds per model, 0 searches until it is done.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/time_budget", 0)
+        # Score the candidates with "numpy", or with "numba", which is faster but compiled at its first use in each
+        # process. "auto" uses numba if it is installed and the model is big enough to make up for the compilation.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/backend", "auto")
+        # Transform and preprocess the meshes in blocks that use at most about this amount of MB, so big models do not
+        # need several full copies of the mesh at once. 0 processes a mesh at once.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/preprocess_memory", 16)
+        # Score a big model in this amount of threads of the orientation job or worker process. 0 shares all cores
+        # between the worker processes.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/threads", 0)
+        # Write a cProfile dump of each orientation to the orientation_profiles folder in the data storage.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/profile", False)
+        # The models that are loaded while auto orientation is on are oriented in batches of at most this size,
+        # one batch at a time, so a run from the menu only waits for the current batch.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/auto_batch_size", 10)
+        self._scheduler = OrientationScheduler(self._createJob, self._getAutoBatchSize(),
+                                               on_idle = self._startNextPrecomputation)
+        self._cache = OrientationCache(os.path.join(Resources.getConfigStoragePath(), "orientation_cache"),
+                                       self._getCacheSize())
+        # Prepare the orientation of loaded models in the background while auto orientation is off.
+        # The memory the prepared models may use is in MB.
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/precompute", False)
+        CuraApplication.getInstance().getPreferences().addPreference("OrientationPlugin/precompute_memory", 512)
+        self._precompute_queue = []  # type: List[SceneNode]
+        self._precompute_job = None  # type: Optional[PrecomputeOrientationJob]
+        self._precomputed = OrderedDict()  # type: OrderedDict[SceneNode, PrecomputeOrientationJob]
 
         self._popup = None
 
@@ -49,15 +109,34 @@ class OrientationPlugin(Extension):
             self._qml_folder = "qml_qt5"
 
     def _onPreferencesChanged(self, name: str) -> None:
+        if name == "OrientationPlugin/cache_size":
+            self._cache.setMaxSize(self._getCacheSize())
+        if name == "OrientationPlugin/auto_batch_size":
+            self._scheduler.setBatchSize(self._getAutoBatchSize())
         if name != "OrientationPlugin/do_auto_orientation":
             return
         self._do_auto_orientation = CuraApplication.getInstance().getPreferences().getValue("OrientationPlugin/do_auto_orientation")
 
+    def _getCacheSize(self) -> int:
+        return int(float(CuraApplication.getInstance().getPreferences().getValue("OrientationPlugin/cache_size")) * 1024 * 1024)
+
+    def _getAutoBatchSize(self) -> int:
+        return int(CuraApplication.getInstance().getPreferences().getValue("OrientationPlugin/auto_batch_size"))
+
+    def _getCache(self) -> Optional[OrientationCache]:
+        if not CuraApplication.getInstance().getPreferences().getValue("OrientationPlugin/use_cache"):
+            return None
+        return self._cache
+
+    @pyqtSlot()
+    def clearCache(self) -> None:
+        self._cache.clear()
+
     def _createPopup(self) -> None:
         # Create the plugin dialog component
         path = os.path.join(cast(str, PluginRegistry.getInstance().getPluginPath(self.getPluginId())), self._qml_folder,
                             "SettingsPopup.qml")
-        self._popup = CuraApplication.getInstance().createQmlComponent(path)
+        self._popup = CuraApplication.getInstance().createQmlComponent(path, {"manager": self})
         if self._popup is None:
             return
 
@@ -74,10 +153,12 @@ class OrientationPlugin(Extension):
     def _onFileCompleted(self, file_name):
         if file_name in self._currently_loading_files:
             self._currently_loading_files.remove(file_name)
+        if self._precompute_queue:
+            CuraApplication.getInstance().callLater(self._startNextPrecomputation)
 
     def _onSceneChanged(self, node):
-        if not self._do_auto_orientation:
-            return  # Nothing to do!
+        if self._precomputed:
+            self._discardStalePrecomputations()
 
         if not node or not node.getMeshData():
             return
@@ -86,24 +167,67 @@ class OrientationPlugin(Extension):
         if node.getMeshData().getFileName() not in self._currently_loading_files:
             return
 
-        # the scene may change multiple times while loading a mesh,
-        # but we want to check the mesh only once
-        if node not in self._check_node_queue:
-            self._check_node_queue.append(node)
-            CuraApplication.getInstance().callLater(self.checkQueuedNodes)
-
-    def checkQueuedNodes(self):
-        for node in self._check_node_queue:
-            if self._message:
-                self._message.hide()
-            auto_orient_message = Message(i18n_catalog.i18nc("@info:status", "Auto-Calculating the optimal orientation because auto orientation is enabled"), 0,
-                                    False, -1, title=i18n_catalog.i18nc("@title", "Auto-Orientation"))
-            auto_orient_message.show()
-            job = CalculateOrientationJob([node], extended_mode=True, message=auto_orient_message)
-            job.finished.connect(self._onFinished)
-            job.start()
-
-        self._check_node_queue = []
+        if not self._do_auto_orientation:
+            if CuraApplication.getInstance().getPreferences().getValue("OrientationPlugin/precompute"):
+                self._queuePrecomputation(node)
+            return
+
+        self._scheduler.queueAutoNode(node)
+
+    def _queuePrecomputation(self, node: SceneNode) -> None:
+        if node in self._precompute_queue or node in self._precomputed:
+            return
+        if self._precompute_job is not None and self._precompute_job.getNode() is node:
+            return
+        self._precompute_queue.append(node)
+
+    def _startNextPrecomputation(self) -> None:
+        """Prepares the queued nodes one after another, once all files are loaded and no orientation job runs."""
+        if self._precompute_job is not None or self._currently_loading_files or not self._precompute_queue:
+            return
+        if self._scheduler.isBusy():
+            return  # The scheduler starts the precomputation again once its queue is done
+        node = self._precompute_queue.pop(0)
+        if node.getParent() is None or not node.getMeshData():
+            CuraApplication.getInstance().callLater(self._startNextPrecomputation)
+            return
+        min_volume = CuraApplication.getInstance().getPreferences().getValue("OrientationPlugin/min_volume")
+        seed = int(CuraApplication.getInstance().getPreferences().getValue("OrientationPlugin/seed"))
+        self._precompute_job = PrecomputeOrientationJob(node, min_volume, seed, CalculateOrientationJob.getPreprocessMemoryLimit())
+        self._precompute_job.finished.connect(self._onPrecomputationFinished)
+        self._precompute_job.start()
+
+    def _onPrecomputationFinished(self, job: PrecomputeOrientationJob) -> None:
+        self._precompute_job = None
+        if job.isCurrent():
+            self._precomputed[job.getNode()] = job
+            memory_limit = float(CuraApplication.getInstance().getPreferences().getValue("OrientationPlugin/precompute_memory")) * 1024 * 1024
+            memory_usage = sum(precomputed.getMemoryUsage() for precomputed in self._precomputed.values())
+            while self._precomputed and memory_usage > memory_limit:  # Drop the oldest first
+                _, precomputed = self._precomputed.popitem(last = False)
+                memory_usage -= precomputed.getMemoryUsage()
+        CuraApplication.getInstance().callLater(self._startNextPrecomputation)
+
+    def _discardStalePrecomputations(self) -> None:
+        """Drops the prepared data of nodes that were deleted, or whose mesh, rotation or scale changed."""
+        for node, precomputed in list(self._precomputed.items()):
+            if not precomputed.isCurrent():
+                del self._precomputed[node]
+        if self._precompute_job is not None and self._precompute_job.getNode().getParent() is None:
+            self._precompute_job.cancel()
+
+    def _takePrecomputed(self, nodes: List[SceneNode], extended_mode: bool) -> Dict[SceneNode, Tweak]:
+        """Hands out the prepared data of the nodes for an orientation job. It is of no use afterwards, as the nodes get rotated."""
+        min_volume = CuraApplication.getInstance().getPreferences().getValue("OrientationPlugin/min_volume")
+        seed = int(CuraApplication.getInstance().getPreferences().getValue("OrientationPlugin/seed"))
+        prepared = {}  # type: Dict[SceneNode, Tweak]
+        for node in nodes:
+            precomputed = self._precomputed.pop(node, None)
+            if precomputed is None or not precomputed.isCurrent():
+                continue
+            if precomputed.getMinVolume() == min_volume and precomputed.getSeed() == seed and extended_mode in precomputed.getPrepared():
+                prepared[node] = precomputed.getPrepared()[extended_mode]
+        return prepared
 
     def doFastAutoOrientation(self):
         self.doAutoOrientation(False)
@@ -122,19 +246,11 @@ class OrientationPlugin(Extension):
             self._message.show()
             return
 
-        message = Message(i18n_catalog.i18nc("@info:status", "Calculating the optimal orientation..."), 0, False, -1, title = i18n_catalog.i18nc("@title", "Auto-Orientation"))
-        message.show()
+        self._scheduler.queueUserRun(selected_nodes, extended_mode)
 
-        job = CalculateOrientationJob(selected_nodes, extended_mode = extended_mode, message = message)
-        job.finished.connect(self._onFinished)
-        job.start()
-
-    def _onFinished(self, job):
-        if self._message:
-            self._message.hide()
-
-        if job.getMessage() is not None:
-            job.getMessage().hide()
-            self._message = Message(i18n_catalog.i18nc("@info:status", "All selected objects have been oriented."),
-                                    title=i18n_catalog.i18nc("@title", "Auto-Orientation"))
-            self._message.show()
+    def _createJob(self, nodes: List[SceneNode], extended_mode: bool, progress_callback: Callable[[float], None]) -> CalculateOrientationJob:
+        """Creates the job for a batch of the scheduler. The prepared data is taken as late as possible, as the
+        preparation of the nodes may still finish while they are queued."""
+        return CalculateOrientationJob(nodes, extended_mode = extended_mode, cache = self._getCache(),
+                                       prepared = self._takePrecomputed(nodes, extended_mode),
+                                       progress_callback = progress_callback)
@@ -0,0 +1,162 @@
+# Copyright (c) 2022 Jaime van Kessel
+# The OrientationPLugin is released under the terms of the AGPLv3 or higher.
+
+from collections import OrderedDict
+
+from UM.Logger import Logger
+from UM.Message import Message
+from UM.Scene.SceneNode import SceneNode
+from cura.CuraApplication import CuraApplication
+
+from .CalculateOrientationJob import CalculateOrientationJob
+
+from UM.i18n import i18nCatalog
+
+from typing import Callable, List, Optional, Set, Tuple
+
+i18n_catalog = i18nCatalog("OrientationPlugin")
+
+# Creates the job for a batch of nodes in the given mode, which reports its progress to the given callback.
+JobFactory = Callable[[List[SceneNode], bool, Callable[[float], None]], CalculateOrientationJob]
+
+
+class OrientationScheduler:
+    """Runs the orientation jobs one at a time, so they neither compete with each other nor with slicing.
+
+    Runs that the user started go first, in the order in which they were requested. The nodes that the auto
+    orientation queues are merged into batches of at most the batch size in between, so a user never waits for more
+    than one batch. The progress of the whole queue is shown in a single message.
+    """
+
+    def __init__(self, create_job: JobFactory, batch_size: int = 10, on_idle: Optional[Callable[[], None]] = None) -> None:
+        self._create_job = create_job
+        self._on_idle = on_idle  # Called whenever the queue is done, e.g. to start work that waited for it
+        self._batch_size = max(batch_size, 1)
+        self._user_runs = []  # type: List[Tuple[List[SceneNode], bool]]
+        self._auto_nodes = OrderedDict()  # type: OrderedDict[SceneNode, None]  # An ordered set of the queued nodes
+        self._job = None  # type: Optional[CalculateOrientationJob]
+        self._job_nodes = set()  # type: Set[SceneNode]
+        self._start_pending = False
+
+        # The progress message covers all nodes that were queued since the queue was last empty.
+        self._message = None  # type: Optional[Message]
+        self._result_message = None  # type: Optional[Message]
+        self._total_count = 0
+        self._done_count = 0
+        self._cancelled = False
+
+    def setBatchSize(self, batch_size: int) -> None:
+        self._batch_size = max(batch_size, 1)
+
+    def queueUserRun(self, nodes: List[SceneNode], extended_mode: bool) -> None:
+        """Orients the nodes in one job, before any auto orientation that is still queued."""
+        for node in nodes:
+            if node in self._auto_nodes:
+                del self._auto_nodes[node]
+                self._total_count -= 1  # This run orients it anyway
+            elif node in self._job_nodes:
+                self._job.discard(node)  # The running job would only orient it from an older state
+        self._user_runs.append((list(nodes), extended_mode))
+        self._total_count += len(nodes)
+        self._scheduleNext()
+
+    def queueAutoNode(self, node: SceneNode) -> None:
+        """Orients the node in the extended mode, together with the other nodes that are queued in the meantime."""
+        # The scene may change multiple times while loading a mesh, but we want to orient it only once.
+        if node in self._auto_nodes or node in self._job_nodes:
+            return
+        self._auto_nodes[node] = None
+        self._total_count += 1
+        self._scheduleNext()
+
+    def cancel(self) -> None:
+        """Stops the running job and drops everything that is queued."""
+        self._cancelled = True
+        self._done_count += len(self._auto_nodes) + sum(len(nodes) for nodes, _ in self._user_runs)
+        self._user_runs = []
+        self._auto_nodes.clear()
+        if self._job is not None:
+            self._job.cancel()
+
+    def isBusy(self) -> bool:
+        return self._job is not None or bool(self._user_runs) or bool(self._auto_nodes)
+
+    def _scheduleNext(self) -> None:
+        # Start on the next event loop iteration, so the nodes that are queued until then share a batch.
+        if self._job is None and not self._start_pending:
+            self._start_pending = True
+            CuraApplication.getInstance().callLater(self._startNext)
+
+    def _startNext(self) -> None:
+        self._start_pending = False
+        if self._job is not None:
+            return
+        if self._user_runs:
+            nodes, extended_mode = self._user_runs.pop(0)
+        elif self._auto_nodes:
+            nodes = []
+            while self._auto_nodes and len(nodes) < self._batch_size:
+                nodes.append(self._auto_nodes.popitem(last = False)[0])
+            extended_mode = True
+        else:
+            self._onQueueFinished()
+            return
+
+        # Nodes may have been deleted while they were waiting.
+        live_nodes = [node for node in nodes if node.getParent() is not None and node.getMeshData()]
+        self._done_count += len(nodes) - len(live_nodes)
+        if not live_nodes:
+            self._scheduleNext()
+            return
+
+        self._showProgress()
+        self._job = self._create_job(live_nodes, extended_mode, self._onJobProgress)
+        self._job_nodes = set(live_nodes)
+        self._job.finished.connect(self._onJobFinished)
+        self._job.start()
+
+    def _onJobProgress(self, progress: float) -> None:
+        """Combines the progress of the running job with the nodes that were done before it."""
+        if self._message is None or self._total_count <= 0:
+            return
+        done = self._done_count + len(self._job_nodes) * progress / 100
+        self._message.setProgress(min(100 * done / self._total_count, 100))
+
+    def _onJobFinished(self, job: CalculateOrientationJob) -> None:
+        self._done_count += len(self._job_nodes)
+        if job.isCancelled():
+            self._cancelled = True
+        self._job = None
+        self._job_nodes = set()
+        self._scheduleNext()
+
+    def _showProgress(self) -> None:
+        text = i18n_catalog.i18nc("@info:status", "Calculating the optimal orientation of {done} of {total} objects...").format(
+            done = self._done_count + 1, total = self._total_count)
+        if self._message is None:
+            if self._result_message is not None:
+                self._result_message.hide()
+            self._message = Message(text, 0, False, -1, title = i18n_catalog.i18nc("@title", "Auto-Orientation"))
+            self._message.addAction("cancel", i18n_catalog.i18nc("@action:button", "Cancel"), "", i18n_catalog.i18nc("@info:tooltip", "Stop calculating the orientation"))
+            self._message.actionTriggered.connect(lambda message, action: self.cancel() if action == "cancel" else None)
+            self._message.show()
+        else:
+            self._message.setText(text)
+        self._onJobProgress(0)
+
+    def _onQueueFinished(self) -> None:
+        if self._message is not None:  # Otherwise all nodes were deleted before they were oriented
+            self._message.hide()
+            if self._cancelled:
+                text = i18n_catalog.i18nc("@info:status", "The calculation of the orientation was cancelled.")
+            else:
+                text = i18n_catalog.i18nc("@info:status", "All selected objects have been oriented.")
+            Logger.log("i", "Finished orienting {count} objects".format(count = self._total_count))
+            self._result_message = Message(text, title = i18n_catalog.i18nc("@title", "Auto-Orientation"))
+            self._result_message.show()
+            self._message = None  # The next queue gets a new progress message
+        self._total_count = 0
+        self._done_count = 0
+        self._cancelled = False
+        if self._on_idle is not None:
+            self._on_idle()
@@ -0,0 +1,163 @@
+# Copyright (c) 2022 Jaime van Kessel
+# The OrientationPLugin is released under the terms of the AGPLv3 or higher.
+
+# Runs the Tweaker for several meshes in a pool of worker processes. This module does not depend on Uranium or
+# Cura, so the worker processes only have to import numpy and the MeshTweaker.
+
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from .MeshTweaker import Tweak, TweakCancelled
+except ImportError:  # Imported as top level module, e.g. in a worker process
+    from MeshTweaker import Tweak, TweakCancelled
+
+_progress = None  # Progress of each task in percent, shared with the parent process. Set by _initializeWorker.
+_cancel_event = None  # Set by the parent process to stop all tasks. Set by _initializeWorker.
+_cancelled = None  # Set to 1 by the parent process to stop a single task. Set by _initializeWorker.
+
+
+def _initializeWorker(progress, cancel_event, cancelled) -> None:
+    global _progress, _cancel_event, _cancelled
+    _progress = progress
+    _cancel_event = cancel_event
+    _cancelled = cancelled
+
+
+class _TaskCancelToken:
+    """The cancel token of a task, which is set when all tasks or this task are cancelled."""
+
+    def __init__(self, index: int) -> None:
+        self._index = index
+
+    def is_set(self) -> bool:
+        return _cancel_event.is_set() or bool(_cancelled[self._index])
+
+
+def _attachSharedMemory(name: str) -> shared_memory.SharedMemory:
+    # The spawned workers share the resource tracker of the parent process, which unlinks the memory when done.
+    try:
+        return shared_memory.SharedMemory(name = name, track = False)
+    except TypeError:  # Python < 3.13
+        return shared_memory.SharedMemory(name = name)
+
+
+def _runTask(index: int, vertices_layout: Tuple[str, Tuple[int, ...], str],
+             indices_layout: Optional[Tuple[str, Tuple[int, ...], str]], tweak_arguments: Dict[str, Any]) -> Optional[Tweak]:
+    """Runs the Tweaker on vertices, and the indices of an indexed mesh, in shared memory, in a worker process.
+
+    A cancelled task returns None instead of raising TweakCancelled. The parent process imports the MeshTweaker under
+    another module name, so it could not catch the exception class of the worker.
+    """
+    memories = []  # type: List[shared_memory.SharedMemory]
+    try:
+        arrays = []
+        for layout in (vertices_layout, indices_layout):
+            if layout is None:
+                arrays.append(None)
+                continue
+            name, shape, dtype = layout
+            memories.append(_attachSharedMemory(name))
+            arrays.append(np.ndarray(shape, dtype = dtype, buffer = memories[-1].buf))
+
+        def updateProgress(progress: float) -> None:
+            if _progress is not None:
+                _progress[index] = progress
+
+        try:
+            result = Tweak(arrays[0], progress_callback = updateProgress, indices = arrays[1],
+                           cancel_token = _TaskCancelToken(index), **tweak_arguments)
+        except TweakCancelled:
+            return None
+        del arrays
+    finally:
+        for memory in memories:
+            memory.close()
+    # The callback and the cancel token can not be sent back to the parent process
+    result.progress_callback = None
+    result.cancel_token = None
+    return result
+
+
+class OrientationPool:
+    """A pool of worker processes that each run the Tweaker for one mesh.
+
+    The vertices and indices are handed to the workers through shared memory, so they don't have to be pickled. The
+    progress of all tasks is gathered in a shared array, so it can be shown as a single progress bar.
+    """
+
+    def __init__(self, worker_count: int, task_count: int) -> None:
+        # Spawn the workers, forking a process that runs Qt and several threads is not safe.
+        context = multiprocessing.get_context("spawn")
+        self._progress = context.Array("d", max(task_count, 1), lock = False)
+        self._cancel_event = context.Event()
+        self._cancelled = context.Array("b", max(task_count, 1), lock = False)
+        self._executor = ProcessPoolExecutor(max_workers = worker_count, mp_context = context,
+                                             initializer = _initializeWorker,
+                                             initargs = (self._progress, self._cancel_event, self._cancelled))
+        self._shared_memory = []  # type: List[shared_memory.SharedMemory]
+        self._futures = {}  # type: Dict[int, Future[Optional[Tweak]]]
+
+    def submit(self, index: int, vertices: np.ndarray, indices: Optional[np.ndarray] = None,
+               **tweak_arguments: Any) -> "Future[Optional[Tweak]]":
+        """Starts the Tweaker for the vertices of a mesh.
+
+        :param index: The index of the task, between 0 and the task count of the pool.
+        :param vertices: The vertices to pass to the Tweaker, these are copied once into shared memory.
+        :param indices: The vertex indices of the faces if the mesh is indexed, these are shared as well.
+        :param tweak_arguments: Keyword arguments of the Tweaker.
+        :return: A future that resolves to the Tweak result, or to None if the task was cancelled after it started.
+        """
+        vertices_layout = self._share(vertices)
+        indices_layout = self._share(indices) if indices is not None else None
+
+        self._progress[index] = 0
+        self._cancelled[index] = 0
+        tweak_arguments.setdefault("verbose", False)
+        self._futures[index] = self._executor.submit(_runTask, index, vertices_layout, indices_layout, tweak_arguments)
+        return self._futures[index]
+
+    def _share(self, array: np.ndarray) -> Tuple[str, Tuple[int, ...], str]:
+        """Copies an array into shared memory, and returns the name, shape and dtype to find it back."""
+        array = np.ascontiguousarray(array)
+        memory = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+        self._shared_memory.append(memory)
+        np.ndarray(array.shape, dtype = array.dtype, buffer = memory.buf)[...] = array
+        return memory.name, array.shape, array.dtype.str
+
+    def getProgress(self, index: Optional[int] = None) -> float:
+        """The progress of a task, or the average progress of all tasks if no index is given."""
+        if index is not None:
+            return self._progress[index]
+        return sum(self._progress) / len(self._progress)
+
+    def setProgress(self, index: int, progress: float) -> None:
+        self._progress[index] = progress
+
+    def cancel(self, index: Optional[int] = None) -> None:
+        """Stops the running tasks at their next check, and the pending tasks as soon as they start.
+
+        :param index: The index of the only task to stop, so its worker moves on to the next task.
+        """
+        if index is None:
+            self._cancel_event.set()
+            return
+        self._cancelled[index] = 1
+        if index in self._futures:
+            self._futures[index].cancel()  # Only succeeds if it did not start yet
+
+    def shutdown(self) -> None:
+        """Stops the workers and releases the shared memory."""
+        self._executor.shutdown(wait = True)
+        for memory in self._shared_memory:
+            memory.close()
+            try:
+                memory.unlink()
+            except FileNotFoundError:
+                pass
+        self._shared_memory = []
@@ -0,0 +1,81 @@
+# Copyright (c) 2022 Jaime van Kessel
+# The OrientationPLugin is released under the terms of the AGPLv3 or higher.
+
+from UM.Job import Job
+from UM.Scene.SceneNode import SceneNode
+from .MeshTweaker import Tweak, TweakCancelled
+from .NodeVersion import NodeVersion
+
+import threading
+import time
+
+from typing import Dict, Optional
+
+# The preparation runs in the background, so it pauses for this amount of seconds between the modes to leave the
+# CPU to the interface and other jobs.
+PRECOMPUTE_PAUSE = 0.1
+
+
+class PrecomputeOrientationJob(Job):
+    """Preprocesses the mesh of a node and gathers the candidate orientations for both the fast and the extended mode
+    ahead of time, so a later orientation only has to score the candidates.
+
+    The job has a low priority: the plugin only starts it while no orientation job runs, and it yields in between.
+    """
+
+    def __init__(self, node: SceneNode, min_volume: bool, seed: Optional[int] = None,
+                 preprocess_memory_limit: Optional[int] = None) -> None:
+        super().__init__()
+        self._node = node
+        self._min_volume = min_volume
+        self._seed = seed
+        self._preprocess_memory_limit = preprocess_memory_limit
+        self._prepared = {}  # type: Dict[bool, Tweak]
+        self._cancel_token = threading.Event()
+        self._version = None  # type: Optional[NodeVersion]
+        self._complete = False  # Whether both modes were prepared, the Tweak may fail for any reason
+
+    def run(self) -> None:
+        self._version = NodeVersion(self._node)
+        transformed_vertices, indices = self._version.getTransformedMesh(self._preprocess_memory_limit)
+        for extended_mode in (False, True):
+            try:
+                self._prepared[extended_mode] = Tweak(transformed_vertices, extended_mode = extended_mode,
+                                                      verbose = False, min_volume = self._min_volume,
+                                                      prepare_only = True, indices = indices, seed = self._seed,
+                                                      preprocess_memory_limit = self._preprocess_memory_limit,
+                                                      cancel_token = self._cancel_token)
+            except TweakCancelled:
+                return
+            Job.yieldThread()
+            time.sleep(PRECOMPUTE_PAUSE)
+        self._complete = True
+
+    def cancel(self) -> None:
+        """Marks the result as stale, e.g. because the node changed while it was being prepared, and stops the
+        preparation."""
+        self._cancel_token.set()
+
+    def isCancelled(self) -> bool:
+        return self._cancel_token.is_set()
+
+    def isCurrent(self) -> bool:
+        """Whether the data of both modes was prepared and still matches the mesh and the rotation and scale of the
+        node."""
+        return self._complete and not self.isCancelled() and self._version is not None and self._version.isCurrent()
+
+    def getNode(self) -> SceneNode:
+        return self._node
+
+    def getMinVolume(self) -> bool:
+        return self._min_volume
+
+    def getSeed(self) -> Optional[int]:
+        return self._seed
+
+    def getPrepared(self) -> Dict[bool, Tweak]:
+        """The prepared Tweak for the fast (False) and the extended (True) mode."""
+        return self._prepared
+
+    def getMemoryUsage(self) -> int:
+        return sum(prepared.mesh.nbytes for prepared in self._prepared.values())
@@ -0,0 +1,79 @@
+# Copyright (c) 2022 Jaime van Kessel
+# The OrientationPLugin is released under the terms of the AGPLv3 or higher.
+
+# Reads and writes STL files for running the Tweaker outside of Cura. This module only depends on numpy.
+
+import os
+import re
+
+import numpy as np
+
+# A binary STL has an 80 byte header, the facet count and a 50 byte record for each facet.
+STL_HEADER_SIZE = 84
+STL_RECORD = np.dtype([("normal", "<f4", (3, )), ("vertices", "<f4", (3, 3)), ("attributes", "<u2")])
+
+_ascii_vertex = re.compile(rb"vertex\s+(\S+)\s+(\S+)\s+(\S+)")
+
+
+def isBinaryStl(path: str) -> bool:
+    """Whether the file has the exact size of a binary STL with the facet count of its header.
+
+    ASCII files can start with "solid" as well as binary files, so the size is the reliable check.
+    """
+    size = os.path.getsize(path)
+    if size < STL_HEADER_SIZE:
+        return False
+    with open(path, "rb") as stl_file:
+        stl_file.seek(80)
+        facet_count = int(np.frombuffer(stl_file.read(4), dtype = "<u4")[0])
+    return size == STL_HEADER_SIZE + facet_count * STL_RECORD.itemsize
+
+
+def readStl(path: str) -> np.ndarray:
+    """Reads the vertices of a binary or ASCII STL file.
+
+    :return: The vertices of all facets with format (facet_count * 3) x 3, as the Tweaker takes them.
+    """
+    if isBinaryStl(path):
+        records = np.fromfile(path, dtype = STL_RECORD, offset = STL_HEADER_SIZE)
+        return records["vertices"].reshape(-1, 3)
+
+    with open(path, "rb") as stl_file:
+        coordinates = _ascii_vertex.findall(stl_file.read())
+    vertices = np.array(coordinates, dtype = np.float64).astype(np.float32).reshape(-1, 3)
+    if len(vertices) == 0 or len(vertices) % 3 != 0:
+        raise ValueError("{path} is not a valid STL file".format(path = path))
+    return vertices
+
+
+def mapStl(path: str) -> np.ndarray:
+    """Maps the facets of a binary STL file into memory, without reading or copying them.
+
+    :return: A read only view with format facet_count x 4 x 3 of the normal and the three vertices of each facet,
+    which the Tweaker takes as it is. The file is only read as far as the view is used.
+    """
+    if not isBinaryStl(path):
+        raise ValueError("{path} is not a binary STL file".format(path = path))
+    facet_count = (os.path.getsize(path) - STL_HEADER_SIZE) // STL_RECORD.itemsize
+    if facet_count == 0:
+        return np.empty((0, 4, 3), dtype = "<f4")
+    data = np.memmap(path, dtype = np.uint8, mode = "r")
+    # The records are 50 bytes, so the normal and the vertices are a strided view that skips the attributes.
+    return np.ndarray((facet_count, 4, 3), dtype = "<f4", buffer = data, offset = STL_HEADER_SIZE,
+                      strides = (STL_RECORD.itemsize, 12, 4))
+
+
+def writeStl(path: str, vertices: np.ndarray, header: bytes = b"") -> None:
+    """Writes the facets of the vertices, with format (facet_count * 3) x 3, as binary STL file."""
+    facets = np.asarray(vertices, dtype = np.float64).reshape(-1, 3, 3)
+    normals = np.cross(facets[:, 1] - facets[:, 0], facets[:, 2] - facets[:, 0])
+    lengths = np.linalg.norm(normals, axis = 1)
+    np.divide(normals, lengths[:, np.newaxis], out = normals, where = lengths[:, np.newaxis] > 0)
+
+    records = np.zeros(len(facets), dtype = STL_RECORD)
+    records["normal"] = normals
+    records["vertices"] = facets
+    with open(path, "wb") as stl_file:
+        stl_file.write(header[:80].ljust(80, b" "))
+        stl_file.write(np.array([len(records)], dtype = "<u4").tobytes())
+        records.tofile(stl_file)
@@ -0,0 +1,247 @@
+# Copyright (c) 2022 Jaime van Kessel
+# The OrientationPLugin is released under the terms of the AGPLv3 or higher.
+
+"""Benchmarks the MeshTweaker on procedurally generated meshes, without Uranium or Cura.
+
+Each case runs Tweak on one mesh in one mode and records the wall time of each phase, the peak memory that is
+allocated while preprocessing and while tweaking and the resulting orientation. The results are written as JSON, so
+two revisions can be compared:
+
+    python benchmarks/benchmark_tweaker.py --quick -o before.json
+    (change the MeshTweaker)
+    python benchmarks/benchmark_tweaker.py --quick -o after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MeshTweaker import BACKENDS, PREPROCESS_MEMORY_LIMIT, Tweak, scoring_backend  # noqa: E402
+
+SIZES = [1000, 10000, 100000, 1000000, 5000000]
+QUICK_SIZES = [1000, 10000, 100000]
+MODES = [(False, False), (False, True), (True, False), (True, True)]  # (extended_mode, min_volume)
+# The Tweaker reports this progress once the mesh is preprocessed.
+PREPROCESSED_PROGRESS = 36
+
+
+def grid_faces(rows, columns, offset=0, closed=False):
+    """Two triangles for each cell of a grid of points, numbered row by row.
+    With closed, the last column connects back to the first one."""
+    width = columns if closed else columns + 1
+    r, c = np.meshgrid(np.arange(rows), np.arange(columns), indexing="ij")
+    a = offset + r * width + c
+    b = offset + r * width + (c + 1) % width
+    faces = np.stack([np.stack([a, a + width, b], axis=-1), np.stack([b, a + width, b + width], axis=-1)], axis=2)
+    return faces.reshape(-1, 3)
+
+
+def box(face_count, size=(60.0, 40.0, 20.0)):
+    """A box whose sides are split into a square grid."""
+    cells = max(int(np.sqrt(face_count / 12)), 1)
+    u = np.linspace(0, 1, cells + 1)
+    uu, vv = [grid.ravel() for grid in np.meshgrid(u, u, indexing="ij")]
+    zeros, ones = np.zeros_like(uu), np.ones_like(uu)
+    sides = [(uu, vv, zeros), (vv, uu, ones), (vv, zeros, uu), (uu, ones, vv), (zeros, uu, vv), (ones, vv, uu)]
+    points, faces = list(), list()
+    for x, y, z in sides:
+        faces.append(grid_faces(cells, cells, offset=len(points) * len(uu)))
+        points.append(np.stack([x, y, z], axis=1))
+    return np.concatenate(points) * size, np.concatenate(faces)[:, ::-1]  # the normals point outwards
+
+
+def plate(face_count):
+    """A thin plate, most faces are nearly parallel."""
+    return box(face_count, size=(120.0, 80.0, 1.5))
+
+
+def sphere(face_count, radius=25.0):
+    """A UV sphere, which has no preferred orientation."""
+    rings = max(int(np.sqrt(face_count / 4)), 2)
+    segments = 2 * rings
+    theta = np.linspace(0, np.pi, rings + 1)
+    phi = np.linspace(0, 2 * np.pi, segments, endpoint=False)
+    tt, pp = np.meshgrid(theta, phi, indexing="ij")
+    points = np.stack([np.sin(tt) * np.cos(pp), np.sin(tt) * np.sin(pp), np.cos(tt)], axis=-1).reshape(-1, 3)
+    return points * radius, grid_faces(rings, segments, closed=True)
+
+
+def scan(face_count, radius=25.0, seed=0):
+    """A noisy organic blob, like the scan of a sculpture."""
+    points, faces = sphere(face_count, radius)
+    rng = np.random.default_rng(seed)
+    directions = points / radius
+    bumps = sum(rng.normal(scale=0.08) * np.sin(directions @ rng.normal(size=3) * frequency + rng.uniform(0, np.pi))
+                for frequency in (1, 2, 3, 5))
+    noise = rng.normal(scale=0.004, size=len(points))
+    return points * (1 + bumps + noise)[:, np.newaxis], faces
+
+
+def gear(face_count, teeth=24, radius=30.0, height=10.0):
+    """An extruded spur gear with flat caps."""
+    resolution = max(int(np.sqrt(face_count / 2) / teeth), 2) * teeth
+    layers = max(int((face_count - 2 * resolution) / (2 * resolution)), 1)
+    angles = np.linspace(0, 2 * np.pi, resolution, endpoint=False)
+    tooth = np.clip(2.5 * np.cos(angles * teeth), -1, 1)  # trapezoidal teeth
+    profile = np.stack([np.cos(angles), np.sin(angles)], axis=1) * (radius + 2 * tooth)[:, np.newaxis]
+    z = np.repeat(np.linspace(0, height, layers + 1), resolution)
+    points = np.column_stack([np.tile(profile, (layers + 1, 1)), z])
+    walls = grid_faces(layers, resolution, closed=True)
+    # the caps are fans around their center
+    centers = np.array([[0, 0, 0], [0, 0, height]])
+    ring = np.arange(resolution)
+    bottom = np.stack([np.full(resolution, len(points)), (ring + 1) % resolution, ring], axis=1)
+    top = np.stack([np.full(resolution, len(points) + 1), layers * resolution + ring,
+                    layers * resolution + (ring + 1) % resolution], axis=1)
+    return np.concatenate([points, centers]), np.concatenate([walls, bottom, top])[:, ::-1]
+
+
+SHAPES = {"box": box, "plate": plate, "sphere": sphere, "gear": gear, "scan": scan}
+
+
+def scale_to_face_area(points, faces, face_area):
+    """Scales a mesh to the given mean face area in mm^2. The extended mode neglects small faces, so meshes
+    with many faces at the size of a printed part are mostly filtered out there."""
+    vertices = points[faces]
+    area = np.linalg.norm(np.cross(vertices[:, 1] - vertices[:, 0], vertices[:, 2] - vertices[:, 0]), axis=1).sum() / 2
+    return points * np.sqrt(face_area * len(faces) / area)
+
+
+def run_case(points, faces, extended_mode, min_volume, indexed, seed, backend=None,
+             preprocess_memory_limit=PREPROCESS_MEMORY_LIMIT, **tweak_arguments):
+    """Runs the Tweaker once and takes the time of each phase from its stats. The tweak_arguments, like the
+    level of detail settings, are passed on."""
+    content = points if indexed else points[faces].reshape(-1, 3)
+    preprocess_peak = list()
+
+    def progress_callback(progress):
+        if progress == PREPROCESSED_PROGRESS:  # the peak of the preprocessing, the input is not counted
+            preprocess_peak.append(tracemalloc.get_traced_memory()[1])
+
+    tracemalloc.start()
+    start = perf_counter()
+    result = Tweak(content, extended_mode=extended_mode, verbose=False, min_volume=min_volume, seed=seed,
+                   indices=faces if indexed else None, backend=backend,
+                   preprocess_memory_limit=preprocess_memory_limit, progress_callback=progress_callback,
+                   **tweak_arguments)
+    total = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "total_s": total,
+        "phases_s": dict(result.stats.phases),
+        "peak_mb": peak / 2 ** 20,
+        "preprocess_peak_mb": preprocess_peak[0] / 2 ** 20 if preprocess_peak else None,
+        "candidates": len(result.best_5),
+        "alignment": [float(component) for component in result.alignment],
+        "unprintability": float(result.unprintability),
+        "lod_winner_changed": result.stats.lod_winner_changed,
+    }
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Prints the ratio of the time and memory of each case against a baseline file."""
+    with open(baseline_path) as baseline_file:
+        baseline = {case_key(case): case for case in json.load(baseline_file)["results"]}
+    print("{:<38} {:>10} {:>10} {:>8} {:>8} {:>10}  {}".format("case", "time [s]", "base [s]", "time", "memory",
+                                                              "preprocess", "orientation"))
+    for case in results:
+        base = baseline.get(case_key(case))
+        if base is None:
+            continue
+        same = np.allclose(case["alignment"], base["alignment"], atol=1e-6)
+        preprocess = "-"
+        if case.get("preprocess_peak_mb") and base.get("preprocess_peak_mb"):  # not measured by older revisions
+            preprocess = "{:.2f}x".format(case["preprocess_peak_mb"] / base["preprocess_peak_mb"])
+        print("{:<38} {:>10.3f} {:>10.3f} {:>7.2f}x {:>7.2f}x {:>10}  {}".format(
+            case_key(case), case["total_s"], base["total_s"], case["total_s"] / max(base["total_s"], 1e-9),
+            case["peak_mb"] / max(base["peak_mb"], 1e-9), preprocess, "same" if same else "CHANGED"))
+
+
+def case_key(case):
+    return "{shape} {faces} {mode}{volume}{indexed}".format(
+        shape=case["shape"], faces=case["faces"], mode="extended" if case["extended_mode"] else "fast",
+        volume=" min_volume" if case["min_volume"] else "", indexed=" indexed" if case["indexed"] else "")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", default="bench_output.json", help="JSON file to write the results to")
+    parser.add_argument("--sizes", type=int, nargs="+", default=None, help="approximate face counts")
+    parser.add_argument("--quick", action="store_true", help="only run meshes up to {} faces".format(QUICK_SIZES[-1]))
+    parser.add_argument("--shapes", nargs="+", choices=sorted(SHAPES), default=sorted(SHAPES))
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each case, the fastest one is kept")
+    parser.add_argument("--indexed", action="store_true", help="pass the meshes with vertex indices")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the candidates of the extended mode")
+    parser.add_argument("--face-area", type=float, default=2.0,
+                        help="mean face area in mm^2 the meshes are scaled to, 0 keeps them at the size of a part")
+    parser.add_argument("--backend", choices=["auto"] + sorted(BACKENDS), default="auto",
+                        help="scoring backend, auto uses numba if it can be imported")
+    parser.add_argument("--preprocess-memory", type=float, default=PREPROCESS_MEMORY_LIMIT / 2 ** 20,
+                        help="MB the blocks of the preprocessing may use, 0 preprocesses a mesh at once")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="threads the backend scores in, by default all for numba and one for numpy")
+    parser.add_argument("--lod-ratio", type=float, default=0,
+                        help="score on this fraction of the faces first, 0 scores all candidates on all faces")
+    parser.add_argument("--lod-top-k", type=int, default=5, help="candidates scored on all faces after the coarse mesh")
+    parser.add_argument("--lod-verify", action="store_true",
+                        help="score all candidates on all faces as well, and count how often the winner changed")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results of an earlier run to compare with")
+    arguments = parser.parse_args()
+
+    sizes = arguments.sizes or (QUICK_SIZES if arguments.quick else SIZES)
+    backend = scoring_backend(arguments.backend, arguments.threads)  # shared by all cases, so the kernels are compiled once
+    preprocess_memory_limit = int(arguments.preprocess_memory * 2 ** 20) if arguments.preprocess_memory > 0 else None
+    lod_arguments = {"lod_ratio": arguments.lod_ratio, "lod_top_k": arguments.lod_top_k,
+                     "lod_verify": arguments.lod_verify}
+    for extended_mode in (False, True):  # warm up numpy and the BLAS, and compile the kernels of the backend
+        run_case(*box(1000), extended_mode, False, arguments.indexed, arguments.seed, backend)
+    results = list()
+    for shape in arguments.shapes:
+        for size in sizes:
+            points, faces = SHAPES[shape](size)
+            if arguments.face_area > 0:
+                points = scale_to_face_area(points, faces, arguments.face_area)
+            for extended_mode, min_volume in MODES:
+                runs = [run_case(points, faces, extended_mode, min_volume, arguments.indexed, arguments.seed, backend,
+                                 preprocess_memory_limit, **lod_arguments) for _ in range(max(arguments.repeat, 1))]
+                case = dict(min(runs, key=lambda run: run["total_s"]), shape=shape, faces=len(faces),
+                            extended_mode=extended_mode, min_volume=min_volume, indexed=arguments.indexed)
+                results.append(case)
+                print("{:<38} {:>8.3f} s {:>9.1f} MB {:>9.1f} MB preprocessing".format(
+                    case_key(case), case["total_s"], case["peak_mb"], case["preprocess_peak_mb"]), file=sys.stderr)
+
+    meta = {"revision": revision(), "python": platform.python_version(), "numpy": np.__version__,
+            "machine": platform.machine(), "processor": platform.processor(), "seed": arguments.seed,
+            "face_area": arguments.face_area, "backend": backend.name, "preprocess_memory": arguments.preprocess_memory,
+            "threads": arguments.threads, **lod_arguments}
+    with open(arguments.output, "w") as output_file:
+        json.dump({"meta": meta, "results": results}, output_file, indent=1)
+    verified = [case["lod_winner_changed"] for case in results if case["lod_winner_changed"] is not None]
+    if verified:
+        print("The coarse ranking changed the winner of {} of {} verified cases".format(sum(verified), len(verified)),
+              file=sys.stderr)
+
+    if arguments.compare:
+        compare(results, arguments.compare)
+
+
+if __name__ == "__main__":
+    main()
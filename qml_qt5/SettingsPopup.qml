@@ -8,7 +8,7 @@ import UM 1.2 as UM
 UM.Dialog
 {
     minimumWidth: 450
-    minimumHeight: 100
+    minimumHeight: 150
     function boolCheck(value) //Hack to ensure a good match between python and qml.
     {
         if(value == "True")
@@ -26,11 +26,42 @@ UM.Dialog
 
     title: "Auto orientation plugin settings"
 
-    CheckBox
+    Column
     {
-        checked: boolCheck(UM.Preferences.getValue("OrientationPlugin/do_auto_orientation"))
-        onClicked: UM.Preferences.setValue("OrientationPlugin/do_auto_orientation", checked)
+        spacing: 10
 
-        text: "Automatically calculate the orientation for all loaded models"
+        CheckBox
+        {
+            checked: boolCheck(UM.Preferences.getValue("OrientationPlugin/do_auto_orientation"))
+            onClicked: UM.Preferences.setValue("OrientationPlugin/do_auto_orientation", checked)
+
+            text: "Automatically calculate the orientation for all loaded models"
+        }
+
+        Row
+        {
+            spacing: 10
+
+            Label
+            {
+                anchors.verticalCenter: parent.verticalCenter
+                text: "Time budget per model in seconds (0 is unlimited)"
+            }
+
+            TextField
+            {
+                width: 60
+                text: UM.Preferences.getValue("OrientationPlugin/time_budget")
+                validator: DoubleValidator { bottom: 0 }
+                onEditingFinished: UM.Preferences.setValue("OrientationPlugin/time_budget", parseFloat(text))
+            }
+        }
+
+        Button
+        {
+            onClicked: manager.clearCache()
+
+            text: "Clear the cache of calculated orientations"
+        }
     }
 }
\ No newline at end of file
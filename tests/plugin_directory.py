@@ -0,0 +1,17 @@
+# Copyright (c) 2022 Jaime van Kessel
+# The OrientationPLugin is released under the terms of the AGPLv3 or higher.
+
+# A pytest plugin, loaded by pytest.ini, that collects the plugin directory as a plain directory. Its __init__.py
+# needs Uranium and Cura, while the tests only use the modules that run without them.
+
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def pytest_collect_directory(path, parent):
+    if str(path) == ROOT:
+        return pytest.Dir.from_parent(parent, path = path)
+    return None
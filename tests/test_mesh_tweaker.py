@@ -0,0 +1,191 @@
+# Copyright (c) 2022 Jaime van Kessel
+# The OrientationPLugin is released under the terms of the AGPLv3 or higher.
+
+import threading
+
+import numpy as np
+import pytest
+
+from benchmark_tweaker import box, gear, plate, scale_to_face_area, scan, sphere
+import MeshTweaker
+from MeshTweaker import Tweak, TweakCancelled
+
+
+def _vertices(points, faces):
+    return points[faces].reshape(-1, 3)
+
+
+def test_prepared_tweak_keeps_the_gathering_time():
+    vertices = _vertices(*sphere(900))
+    prepared = Tweak(vertices, extended_mode=True, verbose=False, seed=0, backend="numpy", prepare_only=True)
+    result = Tweak(vertices, extended_mode=True, verbose=False, seed=0, backend="numpy", prepared=prepared)
+
+    assert result.stats.phases["death_star"] == prepared.stats.phases["death_star"]
+
+
+@pytest.mark.skipif(MeshTweaker.numba is None, reason = "needs Numba")
+def test_backends_agree_on_the_contour_of_a_sphere():
+    # The faces of a UV sphere have many corners at equal heights, which the backends round differently
+    vertices = _vertices(*sphere(900))
+    prepared = Tweak(vertices, extended_mode=True, verbose=False, seed=0, backend="numpy", prepare_only=True)
+    alignments = -np.array([orientation[0] for orientation in prepared.orientations])
+    scores = []
+    for backend in ("numpy", "numba"):
+        prepared.backend = MeshTweaker.scoring_backend(backend)
+        scores.append(np.array(prepared.calc_overhang_batch(alignments, min_volume=False)))
+    np.testing.assert_allclose(scores[0], scores[1], rtol=1e-9)
+
+    results = [Tweak(vertices, extended_mode=True, verbose=False, seed=0, backend=backend)
+               for backend in ("numpy", "numba")]
+    np.testing.assert_array_equal(results[0].alignment, results[1].alignment)
+
+
+@pytest.mark.skipif(MeshTweaker.ConvexHull is None, reason = "needs scipy")
+def test_hull_mode_keeps_the_gathered_candidates():
+    points, faces = scan(30000)
+    vertices = _vertices(scale_to_face_area(points, faces, 2.0), faces)
+    plain = Tweak(vertices, extended_mode=True, verbose=False, seed=0, backend="numpy")
+    hull = Tweak(vertices, extended_mode=True, verbose=False, seed=0, backend="numpy", hull=True)
+
+    assert hull.stats.scored > plain.stats.scored
+    assert hull.unprintability <= plain.unprintability
+
+
+@pytest.mark.skipif(MeshTweaker.ConvexHull is None, reason = "needs scipy")
+def test_hull_min_support_drops_the_candidates_the_part_can_not_stand_on():
+    # A gear stands on one of its caps, the other candidates only touch the build plate with an edge
+    points, faces = gear(10000)
+    vertices = _vertices(scale_to_face_area(points, faces, 2.0), faces)
+    hull = Tweak(vertices, extended_mode=True, verbose=False, seed=0, backend="numpy", hull=True)
+    supported = Tweak(vertices, extended_mode=True, verbose=False, seed=0, backend="numpy", hull=True,
+                      hull_min_support=0.01)
+
+    assert supported.stats.scored < hull.stats.scored / 2
+    assert supported.unprintability == pytest.approx(hull.unprintability)
+    assert abs(supported.alignment[2]) == pytest.approx(1)
+
+
+@pytest.mark.parametrize("extended_mode", [False, True])
+@pytest.mark.parametrize("min_volume", [False, True])
+def test_batched_scoring_equals_scoring_each_orientation(extended_mode, min_volume):
+    points, faces = gear(4000)
+    tweak = Tweak(_vertices(points, faces), extended_mode=extended_mode, verbose=False, min_volume=min_volume, seed=0,
+                  backend="numpy", prepare_only=True)
+    alignments = -np.array([orientation[0] for orientation in tweak.orientations])
+    batched = np.array(tweak.calc_overhang_batch(alignments, min_volume=min_volume))
+
+    for i, alignment in enumerate(alignments):
+        tweak.project_vertices(alignment)
+        np.testing.assert_allclose(batched[:, i], tweak.calc_overhang(alignment, min_volume=min_volume),
+                                   rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize("extended_mode", [False, True])
+def test_indexed_mesh_gives_the_same_orientation(extended_mode):
+    points, faces = scan(10000)
+    expanded = Tweak(_vertices(points, faces), extended_mode=extended_mode, verbose=False, seed=0, backend="numpy")
+    indexed = Tweak(points, extended_mode=extended_mode, verbose=False, seed=0, backend="numpy", indices=faces)
+
+    assert indexed.stats.faces == expanded.stats.faces
+    np.testing.assert_allclose(indexed.alignment, expanded.alignment, atol=1e-9)
+    assert indexed.unprintability == pytest.approx(expanded.unprintability, rel=1e-9)
+
+
+@pytest.mark.parametrize("backend", ["numpy", "numba"])
+@pytest.mark.parametrize("shape", [box, plate])
+def test_pruning_keeps_the_best_orientation(shape, backend):
+    if backend == "numba" and MeshTweaker.numba is None:
+        pytest.skip("needs Numba")
+    vertices = _vertices(*shape(30000))
+    full = Tweak(vertices, extended_mode=True, verbose=False, seed=0, backend=backend)
+    pruned = Tweak(vertices, extended_mode=True, verbose=False, seed=0, backend=backend, prune=True)
+
+    assert pruned.stats.pruned > 0
+    assert pruned.unprintability == pytest.approx(full.unprintability, rel=1e-9)
+    # The sides of a box tie, the pruning may pick another one of them by rounding
+    fully_scored = [result[4] for result in full.best_5 if np.array_equal(result[0], pruned.alignment)]
+    assert fully_scored == [pytest.approx(full.unprintability, rel=1e-9)]
+
+
+def test_cancel_token_stops_the_tweak():
+    cancel_token = threading.Event()
+
+    def progress_callback(progress):
+        if progress > 36:  # Once the mesh is preprocessed
+            cancel_token.set()
+
+    with pytest.raises(TweakCancelled):
+        Tweak(_vertices(*sphere(10000)), extended_mode=True, verbose=False, seed=0, backend="numpy",
+              progress_callback=progress_callback, cancel_token=cancel_token)
+
+
+def test_sort_network_gives_the_median_and_the_maximum():
+    # Small integers, so many of the values tie
+    projections = np.random.default_rng(0).integers(0, 3, size=(1000, 3, 4)).astype(np.float64)
+    median, maximum = np.empty((1000, 4)), np.empty((1000, 4))
+    MeshTweaker.sort_network(projections, median, maximum)
+
+    ordered = np.sort(projections, axis=1)
+    np.testing.assert_array_equal(median, ordered[:, 1])
+    np.testing.assert_array_equal(maximum, ordered[:, 2])
+
+
+def test_reused_workspace_and_small_blocks_give_the_same_scores():
+    points, faces = gear(10000)
+    tweak = Tweak(_vertices(points, faces), extended_mode=True, verbose=False, min_volume=True, seed=0,
+                  backend="numpy", prepare_only=True)
+    alignments = -np.array([orientation[0] for orientation in tweak.orientations])
+    scores = np.array(tweak.calc_overhang_batch(alignments, min_volume=True))
+    np.testing.assert_array_equal(np.array(tweak.calc_overhang_batch(alignments, min_volume=True)), scores)
+
+    # One orientation at a time, in blocks of a few hundred faces
+    tweak.batch_memory_limit = MeshTweaker.BATCH_BYTES_PER_FACE * 300
+    np.testing.assert_allclose(np.array(tweak.calc_overhang_batch(alignments, min_volume=True)), scores,
+                               rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_preprocessing_in_blocks_gives_the_same_mesh(indexed):
+    points, faces = scan(30000)
+    content, indices = (points, faces) if indexed else (_vertices(points, faces), None)
+    meshes, results = [], []
+    for memory_limit in (None, 64 * 1024):
+        arguments = dict(extended_mode=True, verbose=False, seed=0, backend="numpy", indices=indices,
+                         preprocess_memory_limit=memory_limit)
+        meshes.append(Tweak(content, prepare_only=True, **arguments).mesh)
+        results.append(Tweak(content, **arguments))
+
+    for name in ("normals", "vertices", "area", "points", "faces"):
+        np.testing.assert_array_equal(getattr(meshes[1], name), getattr(meshes[0], name))
+    np.testing.assert_array_equal(results[1].alignment, results[0].alignment)
+    assert results[1].unprintability == results[0].unprintability
+
+
+def test_threads_give_the_same_scores(monkeypatch):
+    monkeypatch.setattr(MeshTweaker.os, "cpu_count", lambda: 8)  # The threads are capped at the CPU count
+    points, faces = scan(30000)
+    tweak = Tweak(_vertices(points, faces), extended_mode=True, verbose=False, seed=0, backend="numpy",
+                  prepare_only=True)
+    alignments = -np.array([orientation[0] for orientation in tweak.orientations])
+    tweak.backend = MeshTweaker.NumpyBackend(1)
+    single = np.array(tweak.calc_overhang_batch(alignments, min_volume=False))
+    tweak.backend = MeshTweaker.NumpyBackend(4)
+    threaded = [np.array(tweak.calc_overhang_batch(alignments, min_volume=False)) for _ in range(2)]
+
+    assert len(tweak.thread_workspaces) == 4
+    np.testing.assert_allclose(threaded[0], single, rtol=1e-9, atol=1e-9)
+    # The partial sums are added up in the order of the blocks, whichever thread finishes first
+    np.testing.assert_array_equal(threaded[1], threaded[0])
+
+
+@pytest.mark.parametrize("prune", [False, True])
+def test_threads_give_the_same_orientation(monkeypatch, prune):
+    monkeypatch.setattr(MeshTweaker.os, "cpu_count", lambda: 8)
+    points, faces = box(30000)
+    vertices = _vertices(points, faces)
+    arguments = dict(extended_mode=True, verbose=False, seed=0, backend="numpy", prune=prune)
+    single = Tweak(vertices, threads=1, **arguments)
+    threaded = Tweak(vertices, threads=4, **arguments)
+
+    assert threaded.unprintability == pytest.approx(single.unprintability, rel=1e-9)
+    assert threaded.stats.scored == single.stats.scored
@@ -0,0 +1,66 @@
+# Copyright (c) 2022 Jaime van Kessel
+# The OrientationPLugin is released under the terms of the AGPLv3 or higher.
+
+import time
+from concurrent.futures import CancelledError
+
+import numpy as np
+
+from benchmark_tweaker import box, sphere
+from MeshTweaker import Tweak
+from OrientationWorker import OrientationPool
+
+
+def _vertices(points, faces):
+    return points[faces].reshape(-1, 3)
+
+
+def _waitUntilStarted(pool, index, timeout = 60):
+    start = time.perf_counter()
+    while pool.getProgress(index) <= 0:
+        assert time.perf_counter() - start < timeout, "the task did not start"
+        time.sleep(0.01)
+
+
+def test_pooled_results_can_be_sent_back():
+    vertices = _vertices(*box(1000))
+    pool = OrientationPool(1, 1)
+    try:
+        result = pool.submit(0, vertices, backend = "numpy").result(timeout = 120)
+    finally:
+        pool.shutdown()
+    expected = Tweak(vertices, verbose = False, backend = "numpy")
+    assert result.progress_callback is None and result.cancel_token is None
+    assert np.array_equal(result.alignment, expected.alignment)
+    assert result.unprintability == expected.unprintability
+
+
+def test_cancelling_a_running_task_returns_none():
+    """A stale node cancels its task, which must not raise an exception class the parent can not catch."""
+    pool = OrientationPool(2, 2)
+    try:
+        cancelled = pool.submit(0, _vertices(*sphere(200000)), extended_mode = True, backend = "numpy")
+        other = pool.submit(1, _vertices(*box(1000)))
+        _waitUntilStarted(pool, 0)
+        pool.cancel(0)
+        assert cancelled.result(timeout = 120) is None
+        assert other.result(timeout = 120) is not None
+    finally:
+        pool.shutdown()
+
+
+def test_cancelling_all_tasks_raises_nothing():
+    """After the user cancels, the tasks end with None or as cancelled futures, never with an exception."""
+    pool = OrientationPool(1, 3)
+    try:
+        futures = [pool.submit(index, _vertices(*sphere(200000)), extended_mode = True, backend = "numpy")
+                   for index in range(3)]
+        _waitUntilStarted(pool, 0)
+        pool.cancel()
+        for future in futures:
+            try:
+                assert future.result(timeout = 120) is None
+            except CancelledError:
+                pass
+    finally:
+        pool.shutdown()